@@ -0,0 +1,96 @@
+"""
+rough throughput numbers for utilki.kv
+
+    python benchmarks/kv_bench.py [n]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from utilki import KV, Queue
+
+
+@contextmanager
+def timed(label: str, n: int):
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    print(f"{label:<32} {elapsed:8.3f}s {n / elapsed:12,.0f} ops/s")
+
+
+def fresh_db(tmp: str, name: str) -> str:
+    path = os.path.join(tmp, f"{name}.db")
+    if os.path.exists(path):
+        os.remove(path)
+    return path
+
+
+def bench_set(tmp: str, n: int, profile: str | None = None):
+    data = {f"key:{i}": i for i in range(n)}
+
+    kv = KV(fresh_db(tmp, "set_loop"), profile=profile)
+    with timed("set: per-key loop", n):
+        for key, value in data.items():
+            kv[key] = value
+
+    kv = KV(fresh_db(tmp, "set_many"), profile=profile)
+    with timed("set: set_many", n):
+        kv.set_many(data)
+
+    with timed("get: per-key loop", n):
+        for key in data:
+            kv[key]
+
+    with timed("get: get_many", n):
+        kv.get_many(data)
+
+    with timed("delete: delete_many", n):
+        kv.delete_many(data)
+
+
+def bench_incr(tmp: str, n: int, profile: str | None = None):
+    keys = [f"counter:{i % 100}" for i in range(n)]
+
+    kv = KV(fresh_db(tmp, "incr"), default=0, profile=profile)
+    with timed("incr: per-key", n):
+        for key in keys:
+            kv.incr(key)
+
+    amounts: dict[str, int] = {}
+    for key in keys:
+        amounts[key] = amounts.get(key, 0) + 1
+    with timed("incr: incr_many", n):
+        kv.incr_many(amounts)
+
+
+def bench_queue(tmp: str, n: int, profile: str | None = None):
+    q = Queue(fresh_db(tmp, "queue"), profile=profile)
+    with timed("queue: put_many", n):
+        q.put_many({"n": i} for i in range(n))
+
+    with timed("queue: claim(100) + ack", n):
+        while jobs := q.claim(batch=100):
+            q.ack(jobs)
+
+    # the same again with 10 * n jobs leased to someone else, and as many
+    # delayed, which claim() shouldn't have to look at
+    q.put_many(({"n": i} for i in range(10 * n)), priority=1)
+    q.claim(batch=10 * n, lease=3600)
+    q.put_many(({"n": i} for i in range(10 * n)), delay=3600)
+    q.put_many({"n": i} for i in range(n))
+    with timed("queue: claim(100) + ack, busy", n):
+        while jobs := q.claim(batch=100):
+            q.ack(jobs)
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5_000
+    for profile in [None, "safe", "fast", "bulk-load", "read-mostly"]:
+        print(f"# profile={profile}")
+        with tempfile.TemporaryDirectory() as tmp:
+            bench_set(tmp, n, profile)
+            bench_incr(tmp, n, profile)
+            bench_queue(tmp, n, profile)
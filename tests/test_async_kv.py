@@ -0,0 +1,136 @@
+import asyncio
+import time
+
+from pytest import raises
+
+from utilki import KV, AsyncKV
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_basic_ops(tmp_path):
+    async def main():
+        async with AsyncKV(str(tmp_path / "kv.db"), default=0) as kv:
+            await kv.set("a", {"n": 1})
+            await kv.set_many({"b": 2, "c": 3})
+            assert await kv.get("a") == {"n": 1}
+            assert await kv.get("missing") == 0
+            assert await kv.incr("b", 5) == 7
+            assert await kv.get_many(["b", "c"]) == {"b": 7, "c": 3}
+            assert await kv.delete_many(["c"]) == 1
+            await kv.delete("a")
+            assert await kv.len() == 1
+            assert [key async for key in kv] == ["b"]
+            assert await kv.dict() == {"b": 7}
+
+    run(main())
+
+
+def test_concurrent_writers_are_coalesced(tmp_path):
+    db = str(tmp_path / "kv.db")
+
+    async def main():
+        async with AsyncKV(db, default=0) as kv:
+            statements: list[str] = []
+            await kv._write(
+                lambda: kv.kv._db.set_trace_callback(statements.append)
+            )
+            await asyncio.gather(*(kv.incr("n") for _ in range(200)))
+            assert await kv.get("n") == 200
+            assert statements.count("BEGIN IMMEDIATE TRANSACTION") < 200
+
+    run(main())
+    assert KV(db)["n"] == 200
+
+
+def test_failing_write_does_not_fail_the_batch():
+    async def main():
+        async with AsyncKV() as kv:
+            results = await asyncio.gather(
+                kv.set("a", 1),
+                kv.delete("missing"),
+                kv.set("b", 2),
+                return_exceptions=True,
+            )
+            assert isinstance(results[1], KeyError)
+            assert await kv.dict() == {"a": 1, "b": 2}
+
+    run(main())
+
+
+def test_lock():
+    async def main():
+        async with AsyncKV() as kv:
+            await kv.set("a", 1)
+            async with kv.lock(default=10):
+                assert await kv.get("missing") == 10
+                await kv.set("a", 2)
+                assert await kv.get("a") == 2
+                async with kv.lock():
+                    await kv.incr("a")
+
+            with raises(RuntimeError):
+                async with kv.lock():
+                    await kv.set("a", 100)
+                    raise RuntimeError
+            assert await kv.get("a") == 3
+            with raises(KeyError):
+                await kv.get("missing")
+
+    run(main())
+
+
+def test_lock_holds_back_other_writers():
+    async def main():
+        async with AsyncKV() as kv:
+            await kv.set("a", 0)
+            entered = asyncio.Event()
+            release = asyncio.Event()
+
+            async def holder():
+                async with kv.lock():
+                    value = await kv.get("a")
+                    entered.set()
+                    await release.wait()
+                    await kv.set("a", value + 1)
+
+            task = asyncio.create_task(holder())
+            await entered.wait()
+            write = asyncio.create_task(kv.set("a", 10))
+            await asyncio.sleep(0.05)
+            assert not write.done()
+            release.set()
+            await task
+            await write
+            assert await kv.get("a") == 10
+
+    run(main())
+
+
+def test_cancelled_writes_dont_stop_the_writer():
+    async def main():
+        async with AsyncKV() as kv:
+            # keep the writer busy so the next ops are cancelled while queued
+            busy = asyncio.ensure_future(kv._write(time.sleep, 0.1))
+            await asyncio.sleep(0.01)
+            with raises(asyncio.TimeoutError):
+                await asyncio.wait_for(kv.set("a", 1), 0.01)
+
+            async def locked():
+                async with kv.lock():
+                    await kv.set("b", 1)
+
+            task = asyncio.ensure_future(locked())
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with raises(asyncio.CancelledError):
+                await task
+            await busy
+            await asyncio.wait_for(kv.set("c", 1), 1)
+            async with kv.lock():
+                await kv.set("d", 1)
+            assert await asyncio.wait_for(kv.dict(), 1) == {"c": 1, "d": 1}
+
+    run(main())
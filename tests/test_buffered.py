@@ -0,0 +1,112 @@
+import sqlite3
+import subprocess
+import sys
+
+from pytest import raises
+
+from utilki import KV, BufferedKV
+
+
+def test_reads_see_buffered_writes(tmp_path):
+    db = str(tmp_path / "kv.db")
+    kv = BufferedKV(db, default=0, flush_interval=None)
+    kv["a"] = {"n": 1}
+    kv.incr("b", 2)
+    kv.incr("b", 3)
+    kv.x += 1  # type: ignore
+    kv.x += 1  # type: ignore
+    assert kv["a"] == {"n": 1}
+    assert kv["b"] == 5
+    assert kv["x"] == 2
+    assert len(KV(db)) == 0
+
+    kv.flush()
+    assert KV(db).dict() == {"a": {"n": 1}, "b": 5, "x": 2}
+
+
+def test_coalescing():
+    kv = BufferedKV(default=0, flush_interval=None)
+    kv["a"] = 1
+    kv.incr("a", 2)
+    del kv["a"]
+    assert kv["a"] == 0
+    assert kv.incr("a") == 1
+    with raises(KeyError):
+        del kv["missing"]
+    assert kv.dict() == {"a": 1}
+    kv["b"] = 2
+    assert dict(kv.items()) == {"a": 1, "b": 2}
+    kv["c"] = 3
+    assert sorted(kv.values()) == [1, 2, 3]
+
+
+def test_increments_add_up_across_writers(tmp_path):
+    db = str(tmp_path / "kv.db")
+    one = BufferedKV(db, default=0, flush_interval=None)
+    two = BufferedKV(db, default=0, flush_interval=None)
+    for _ in range(10):
+        one.incr("n")
+        two.incr("n")
+    one.flush()
+    two.flush()
+    assert KV(db)["n"] == 20
+
+
+def test_flush_thresholds(tmp_path):
+    db = str(tmp_path / "kv.db")
+    kv = BufferedKV(db, max_pending=3, flush_interval=None)
+    kv.set_many({"a": 1, "b": 2})
+    assert len(KV(db)) == 0
+    kv["c"] = 3
+    assert len(KV(db)) == 3
+
+    kv = BufferedKV(db, flush_interval=0)
+    kv["d"] = 4
+    assert KV(db)["d"] == 4
+
+
+def test_context_manager_and_lock(tmp_path):
+    db = str(tmp_path / "kv.db")
+    with BufferedKV(db, flush_interval=None) as kv:
+        kv["a"] = 1
+    assert KV(db)["a"] == 1
+
+    with raises(RuntimeError):
+        with kv.lock():
+            kv["a"] = 2
+            raise RuntimeError
+    assert kv["a"] == 1
+    assert kv.get_many(["a", "b"]) == {"a": 1}
+    assert kv.delete_many(["a", "b"]) == 1
+    kv.flush()
+    assert len(KV(db)) == 0
+
+
+def test_failed_flush_keeps_the_buffer(tmp_path):
+    db = str(tmp_path / "kv.db")
+    KV(db)["n"] = 1
+    kv = BufferedKV(db, timeout=0, flush_interval=None)
+    kv.incr("n", 2)
+    kv["a"] = 1
+    with KV(db).lock():
+        with raises(sqlite3.OperationalError):
+            kv.flush()
+    assert kv["n"] == 3
+    assert kv.incr("n") == 4
+    kv.flush()
+    assert KV(db).dict() == {"n": 4, "a": 1}
+
+
+def test_flush_at_exit(tmp_path):
+    db = str(tmp_path / "kv.db")
+    script = (
+        "from utilki import BufferedKV\n"
+        f"kept = BufferedKV({db!r}, table='kept', flush_interval=None)\n"
+        "kept['a'] = 1\n"
+        f"lost = BufferedKV({db!r}, table='lost', flush_interval=None,"
+        " flush_at_exit=False)\n"
+        "lost['a'] = 1\n"
+    )
+    subprocess.run([sys.executable, "-c", script], check=True)
+    assert KV(db, table="kept").dict() == {"a": 1}
+    assert KV(db, table="lost").dict() == {}
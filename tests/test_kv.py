@@ -0,0 +1,916 @@
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+import pandas as pd
+from pytest import fixture, mark, raises
+
+import utilki.kv as kv_module
+from utilki import KV, ChangesLost, Codec, ConflictError, KVStore
+
+
+@fixture
+def kv() -> KV:
+    return KV()
+
+
+def test_set_many_get_many(kv: KV):
+    kv.set_many({"a": 1, "b": [2], "c": {"d": 3}})
+    kv.set_many([("a", 10), ("e", None)])
+    assert kv.get_many(["a", "b", "c", "e", "missing"]) == {
+        "a": 10,
+        "b": [2],
+        "c": {"d": 3},
+        "e": None,
+    }
+    assert len(kv) == 4
+
+
+def test_get_many_default():
+    kv = KV(default=0)
+    kv["a"] = 1
+    assert kv.get_many(["a", "b"]) == {"a": 1, "b": 0}
+
+
+def test_many_chunks(kv: KV):
+    kv.set_many((f"k{i}", i) for i in range(1234))
+    got = kv.get_many(f"k{i}" for i in range(1234))
+    assert got == {f"k{i}": i for i in range(1234)}
+    assert kv.delete_many(f"k{i}" for i in range(1000)) == 1000
+    assert len(kv) == 234
+
+
+def test_delete_many_missing(kv: KV):
+    kv["a"] = 1
+    assert kv.delete_many(["a", "b"]) == 1
+    with raises(KeyError):
+        kv["a"]
+
+
+def test_update(kv: KV):
+    kv.update({"a": 1}, b=2)
+    kv.update([("c", 3)])
+    assert kv.dict() == {"a": 1, "b": 2, "c": 3}
+
+
+def test_set_many_rolls_back(kv: KV):
+    kv["a"] = 1
+
+    def rows():
+        yield "a", 2
+        raise RuntimeError
+
+    with raises(RuntimeError):
+        kv.set_many(rows())
+    assert kv["a"] == 1
+
+
+def test_overwrite_and_delete(kv: KV):
+    kv["a"] = 1
+    kv["a"] = {"b": 2}
+    assert kv["a"] == {"b": 2}
+    assert len(kv) == 1
+    del kv["a"]
+    with raises(KeyError):
+        del kv["a"]
+    assert len(kv) == 0
+
+
+def test_overwrite_is_one_statement(kv: KV):
+    statements: list[str] = []
+    kv._db.set_trace_callback(statements.append)
+    kv["a"] = 1
+    kv["a"] = 2
+    del kv["a"]
+    assert len(statements) == 3
+
+
+def test_incr_decr():
+    kv = KV(default=0)
+    assert kv.incr("a") == 1
+    assert kv.incr("a", 5) == 6
+    assert kv.decr("a", 2) == 4
+    assert kv["a"] == 4
+    kv.b += 3  # type: ignore
+    assert kv["b"] == 3
+
+
+def test_incr_without_default(kv: KV):
+    with raises(KeyError):
+        kv.incr("a")
+    kv["a"] = 1
+    assert kv.incr("a") == 2
+
+
+def test_incr_falls_back_for_non_integers():
+    kv = KV(default=0)
+    kv["f"] = 0.5
+    assert kv.incr("f", 0.25) == 0.75
+    kv["big"] = 2**70
+    assert kv.incr("big") == 2**70 + 1
+    kv["s"] = "x"
+    with raises(TypeError):
+        kv.incr("s")
+    assert kv["s"] == "x"
+
+
+def test_incr_is_one_statement():
+    kv = KV(default=0)
+    statements: list[str] = []
+    kv._db.set_trace_callback(statements.append)
+    kv.incr("a")
+    kv.incr("a")
+    assert len(statements) == 2
+
+
+def test_incr_many():
+    kv = KV(default=10)
+    kv["a"] = 1
+    assert kv.incr_many({"a": 2, "b": -3}) == {"a": 3, "b": 7}
+    assert kv.dict() == {"a": 3, "b": 7}
+
+
+def test_codecs(tmp_path):
+    db = str(tmp_path / "kv.db")
+    kv = KV(db, codec="pickle")
+    when = datetime(2012, 12, 12, 12, 12)
+    kv["when"] = when
+    kv["raw"] = b"\x00\xff"
+    assert kv["when"] == when
+    assert kv["raw"] == b"\x00\xff"
+    [[kind]] = kv._execute("SELECT typeof(value) FROM kv WHERE key='raw'")
+    assert kind == "blob"
+    assert KV(db)["when"] == when
+    with raises(ValueError):
+        KV(db, codec="json")
+    assert kv.clone("other")._codec.name == "pickle"
+
+
+def test_bytes_codec():
+    kv = KV(codec="bytes")
+    kv["a"] = b"abc"
+    assert kv["a"] == b"abc"
+    with raises(TypeError):
+        kv["b"] = "abc"
+
+
+@mark.skipif(sys.version_info < (3, 11), reason="needs sqlite3.Blob")
+def test_open_blob():
+    kv = KV(codec="bytes", counted=True)
+    data = bytes(range(256)) * 1000
+    with kv.open_blob("a", "wb", size=len(data)) as blob:
+        for i in range(0, len(data), 4096):
+            blob.write(data[i : i + 4096])
+    assert kv["a"] == data
+    with kv.open_blob("a") as blob:
+        assert len(blob) == len(data)
+        blob.seek(1000)
+        assert blob.read(10) == data[1000:1010]
+    assert kv.stats()["value_bytes"] == len(data)
+    with raises(KeyError):
+        kv.open_blob("missing")
+    with raises(ValueError):
+        kv.open_blob("b", "wb")
+    with raises(TypeError):
+        KV().open_blob("a")
+
+
+def test_open_blob_needs_blobopen(monkeypatch):
+    kv = KV(codec="bytes")
+    monkeypatch.setattr(
+        kv_module, "sqlite3", SimpleNamespace(Connection=object)
+    )
+    with raises(RuntimeError, match="3.11"):
+        kv.open_blob("a")
+
+
+def test_custom_codec(tmp_path):
+    class Upper(Codec):
+        name = "upper"
+
+        def encode(self, value: str) -> str:
+            return value.upper()
+
+        def decode(self, data: str) -> str:
+            return data
+
+    db = str(tmp_path / "kv.db")
+    KV(db, codec=Upper())["a"] = "abc"
+    assert KV(db, codec=Upper())["a"] == "ABC"
+    with raises(ValueError):
+        KV(db)
+
+
+def test_compression(tmp_path):
+    db = str(tmp_path / "kv.db")
+    kv = KV(db, compress="zlib")
+    kv["small"] = "x"
+    kv["big"] = "x" * 100_000
+    assert kv["big"] == "x" * 100_000
+    assert kv._codec.name == "json+zlib"
+    [[nbytes]] = kv._execute("SELECT length(value) FROM kv WHERE key='big'")
+    assert nbytes < 1000
+    # the stored codec name is enough to reopen it
+    assert KV(db)["small"] == "x"
+    with raises(ValueError):
+        KV(db, codec="json")
+    kv = KV(codec="pickle", compress="lzma")
+    kv["a"] = {"n": bytes(10_000)}
+    assert kv["a"] == {"n": bytes(10_000)}
+    with raises(ValueError):
+        KV(compress="brotli")
+
+
+def test_legacy_table_is_json(tmp_path):
+    db = str(tmp_path / "kv.db")
+    con = sqlite3.connect(db)
+    con.execute("CREATE TABLE kv (key PRIMARY KEY, value)")
+    con.execute("""INSERT INTO kv VALUES ('a', '{"b": 1}')""")
+    con.commit()
+    assert KV(db)["a"] == {"b": 1}
+    with raises(ValueError):
+        KV(db, codec="pickle")
+
+
+def test_cache_hits_and_invalidation(tmp_path):
+    db = str(tmp_path / "kv.db")
+    kv = KV(db, cache_size=2)
+    kv["a"] = {"n": 1}
+    kv["b"] = None
+    assert kv["a"] == {"n": 1}
+    assert kv["a"] == {"n": 1}
+    assert kv["b"] is None
+    assert kv["b"] is None
+    assert kv.cache_info().hits == 2
+
+    kv["a"]["n"] = 2
+    assert kv["a"] == {"n": 1}
+
+    KV(db)["a"] = {"n": 3}
+    assert kv["a"] == {"n": 3}
+
+    kv["a"] = 4
+    assert kv["a"] == 4
+    assert "c" not in kv
+    assert "c" not in kv
+    assert kv.cache_info().currsize == 2
+
+
+def test_cached_get_many(tmp_path):
+    db = str(tmp_path / "kv.db")
+    kv = KV(db, cache_size=10)
+    kv.set_many({"a": 1, "b": 2, "c": 3})
+    assert kv.get_many("abc") == {"a": 1, "b": 2, "c": 3}
+    statements: list[str] = []
+    kv._db.set_trace_callback(statements.append)
+    assert kv.get_many("abcd") == {"a": 1, "b": 2, "c": 3}
+    assert statements.count("PRAGMA data_version") == 1
+    KV(db)["a"] = 4
+    assert kv.get_many("ab") == {"a": 4, "b": 2}
+
+
+def test_cache_rollback():
+    kv = KV(cache_size=10)
+    kv["a"] = 1
+    with raises(RuntimeError):
+        with kv.lock():
+            kv["a"] = 2
+            assert kv["a"] == 2
+            raise RuntimeError
+    assert kv["a"] == 1
+
+
+def test_cache_after_commit(tmp_path):
+    # another thread caches the old value while the transaction is open,
+    # the writer's own data_version doesn't move when it commits
+    kv = KV(str(tmp_path / "kv.db"), threadsafe=True, cache_size=10)
+    kv.set_many({"a": 1, "b": 1})
+    assert kv.get_many("ab") == {"a": 1, "b": 1}
+    with kv.lock():
+        kv["a"] = 2
+        kv.delete_prefix("b")
+        reader = threading.Thread(target=lambda: kv.get_many("ab"))
+        reader.start()
+        reader.join()
+    assert kv.get_many("ab") == {"a": 2}
+
+
+def test_cache_shared_with_uncached_kv(tmp_path):
+    db = str(tmp_path / "kv.db")
+    kv = KV(db, threadsafe=True, cache_size=10)
+    kv.set_many({"a": 1, "b": 1, "c": 1})
+    assert kv.get_many("abc") == {"a": 1, "b": 1, "c": 1}
+    KV(db, threadsafe=True)["a"] = 2
+    kv.clone("kv")["b"] = 2
+    kv.clone("kv").delete_prefix("c")
+    assert kv.get_many("abc") == {"a": 2, "b": 2}
+
+
+def test_cache_bytes():
+    kv = KV(cache_bytes=10)
+    kv.set_many({"a": "x" * 6, "b": "y" * 6})
+    assert kv.get_many(["a", "b"]) == {"a": "x" * 6, "b": "y" * 6}
+    info = kv.cache_info()
+    assert info.currsize == 1
+    assert info.nbytes <= 10
+
+
+def test_threadsafe(tmp_path):
+    for db in [":memory:", str(tmp_path / "kv.db")]:
+        kv = KV(db, default=0, threadsafe=True, cache_size=100)
+
+        def work(i: int):
+            with kv.lock():
+                with kv.lock():
+                    kv.incr("n")
+            kv[f"k{i}"] = i
+            return kv[f"k{i}"]
+
+        with ThreadPoolExecutor(16) as pool:
+            assert list(pool.map(work, range(200))) == list(range(200))
+        assert kv["n"] == 200
+        assert len(kv) == 201
+
+
+def test_threadsafe_lock_default_is_per_thread():
+    kv = KV(threadsafe=True)
+    entered, release = threading.Event(), threading.Event()
+    seen = []
+
+    def hold():
+        with kv.lock(default=1):
+            entered.set()
+            release.wait()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    entered.wait()
+    seen.append(kv._default)
+    release.set()
+    thread.join()
+    assert seen == [None]
+
+
+def test_not_threadsafe():
+    kv = KV()
+    errors = []
+
+    def use():
+        try:
+            kv["a"] = 1
+        except sqlite3.ProgrammingError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=use)
+    thread.start()
+    thread.join()
+    assert len(errors) == 1
+
+
+def test_profiles(tmp_path):
+    db = str(tmp_path / "kv.db")
+    kv = KV(db)
+    assert kv.profile()["profile"] is None
+    assert kv.profile()["journal_mode"] == "delete"
+
+    kv = KV(db, profile="fast")
+    info = kv.profile()
+    assert info["profile"] == "fast"
+    assert info["journal_mode"] == "wal"
+    assert info["synchronous"] == "NORMAL"
+
+    info = KV(db, profile="read-mostly").profile()
+    assert info["mmap_size"] == 1 << 30
+
+    info = KV(db, profile={"synchronous": "OFF", "busy_timeout": 1}).profile()
+    assert info["profile"] == "custom"
+    assert info["synchronous"] == "OFF"
+    assert info["busy_timeout"] == 1
+
+    with raises(ValueError):
+        KV(db, profile="yolo")
+
+
+def test_bulk_load_profile(tmp_path):
+    kv = KV(str(tmp_path / "kv.db"), profile="bulk-load")
+    assert kv.profile()["journal_mode"] == "off"
+    kv.set_many((str(i), i) for i in range(100))
+    assert len(kv) == 100
+
+
+def test_attribute_increments():
+    kv = KV(default=0)
+    for _ in range(3):
+        kv.hits += 2  # type: ignore
+    assert kv["hits"] == 6
+
+
+def test_streaming_items(kv: KV):
+    kv.set_many((f"k{i:04}", i) for i in range(2500))
+    statements: list[str] = []
+    kv._db.set_trace_callback(statements.append)
+    items = [item for item in kv.items()]
+    assert items[:2] == [("k0000", 0), ("k0001", 1)]
+    assert len(statements) == 3
+    assert sum(kv.values()) == sum(range(2500))
+    assert kv.dict() == {f"k{i:04}": i for i in range(2500)}
+    assert ("k0001", 1) in kv.items()
+    assert len(kv.items()) == 2500
+
+
+def test_iter_batches():
+    kv = KV(batch_size=2)
+    assert list(kv.iter_batches()) == []
+    kv.update(a=1, b=2, c=3, d=4)
+    assert [len(batch) for batch in kv.iter_batches()] == [2, 2]
+    assert [len(batch) for batch in kv.iter_batches(3)] == [3, 1]
+
+
+def test_counted_len(tmp_path):
+    db = str(tmp_path / "kv.db")
+    KV(db).set_many({"a": "x", "b": "yy"})
+    kv = KV(db, counted=True)
+    assert len(kv) == 2
+    assert kv.stats()["value_bytes"] == len('"x""yy"')
+
+    kv["c"] = 1
+    kv["a"] = "xxxx"
+    del kv["b"]
+    kv.delete_many(["c", "missing"])
+    other = KV(db)
+    other.set_many({"d": [1], "e": None})
+
+    statements: list[str] = []
+    kv._db.set_trace_callback(statements.append)
+    assert len(kv) == 3
+    assert statements == [kv._sql.counted_len]
+    stats = kv.stats()
+    assert stats["rows"] == 3
+    assert stats["value_bytes"] == len('"xxxx"[1]null')
+    assert stats["page_count"] > 0
+    assert stats["freelist_count"] >= 0
+    assert len(KV(db)) == 3
+    kv.set("f", 1, ttl=0.01)
+    time.sleep(0.02)
+    assert len(kv) == len(KV(db)) == len(list(kv)) == 3
+
+
+def test_stats_uncounted(kv: KV):
+    kv["a"] = 1
+    assert kv.stats()["rows"] is None
+    assert len(kv) == 1
+
+
+def test_ttl():
+    kv = KV(default=0)
+    kv.set("old", 1, ttl=-1)
+    kv.set("new", 2, ttl=60)
+    kv["forever"] = 3
+    assert kv["old"] == 0
+    assert kv["new"] == 2
+    assert sorted(kv) == ["forever", "new"]
+    assert len(kv) == 2
+    assert kv.dict() == {"new": 2, "forever": 3}
+    assert kv.get_many(["old", "new"]) == {"old": 0, "new": 2}
+    assert kv.incr("old") == 1
+    assert kv["old"] == 1
+
+
+def test_ttl_delete_and_purge(kv: KV):
+    kv.set_many({"a": 1, "b": 2}, ttl=-1)
+    kv["c"] = 3
+    with raises(KeyError):
+        del kv["a"]
+    assert kv.delete_many(["b", "c"]) == 1
+
+    kv.set_many({f"k{i}": i for i in range(5)}, ttl=-1)
+    assert kv.purge_expired(limit=3) == 3
+    assert kv.purge_expired() == 2
+    [[n]] = kv._execute("SELECT COUNT(*) FROM kv")
+    assert n == 0
+
+
+def test_default_ttl_and_purge_on_write():
+    kv = KV(default_ttl=-1, purge_every=10)
+    kv.set_many({f"k{i}": i for i in range(9)})
+    kv.set("keep", 1, ttl=60)
+    [[n]] = kv._execute("SELECT COUNT(*) FROM kv")
+    assert n == 1
+    assert kv["keep"] == 1
+
+
+def test_ttl_cache():
+    kv = KV(cache_size=10)
+    kv.set("a", 1, ttl=0.05)
+    assert kv["a"] == 1
+    time.sleep(0.1)
+    with raises(KeyError):
+        kv["a"]
+
+
+def test_ttl_migrates_old_tables(tmp_path):
+    db = str(tmp_path / "kv.db")
+    con = sqlite3.connect(db)
+    con.execute("CREATE TABLE kv (key PRIMARY KEY, value)")
+    con.execute("INSERT INTO kv VALUES ('a', '1')")
+    con.commit()
+    kv = KV(db)
+    kv.set("b", 2, ttl=-1)
+    assert kv.dict() == {"a": 1}
+
+
+def test_purge_in_background(tmp_path):
+    kv = KV(str(tmp_path / "kv.db"), purge_every=0)
+    kv.set_many({f"k{i}": i for i in range(10)}, ttl=-1)
+    stop = kv.purge_in_background(interval=0.01, limit=3)
+    for _ in range(100):
+        [[n]] = kv._execute("SELECT COUNT(*) FROM kv")
+        if not n:
+            break
+        time.sleep(0.01)
+    stop.set()
+    assert n == 0
+
+
+def test_scan():
+    kv = KV(batch_size=2)
+    kv.set_many({"job:1:a": 1, "job:1:b": 2, "job:1:c": 3, "job:2:a": 4})
+    kv["job:1"] = 0
+    kv.set("job:1:old", 5, ttl=-1)
+    assert list(kv.scan(prefix="job:1:")) == [
+        ("job:1:a", 1),
+        ("job:1:b", 2),
+        ("job:1:c", 3),
+    ]
+    assert [k for k, _ in kv.scan(prefix="job:1:", reverse=True)] == [
+        "job:1:c",
+        "job:1:b",
+        "job:1:a",
+    ]
+    assert [k for k, _ in kv.scan(prefix="job:", limit=3)] == [
+        "job:1",
+        "job:1:a",
+        "job:1:b",
+    ]
+    assert [k for k, _ in kv.scan(start="job:1:b", end="job:2")] == [
+        "job:1:b",
+        "job:1:c",
+    ]
+    assert [k for k, _ in kv.scan(prefix="job:1:", start="job:1:c")] == [
+        "job:1:c"
+    ]
+    assert len(list(kv.scan())) == 5
+
+
+def test_scan_uses_index(kv: KV):
+    [*_, (detail,)] = [
+        row[3:]
+        for row in kv._execute(
+            "EXPLAIN QUERY PLAN "
+            + kv._sql.scan.format(" AND key >= ?", "ASC"),
+            ("a", 10),
+        )
+    ]
+    assert "USING INDEX" in detail
+
+
+def test_delete_prefix():
+    kv = KV(cache_size=10)
+    kv.set_many({"a:1": 1, "a:2": 2, "ab": 3, "b": 4, "\U0010ffff": 5})
+    assert kv["a:1"] == 1
+    assert kv.delete_prefix("a:") == 2
+    assert "a:1" not in kv
+    assert sorted(kv) == ["ab", "b", "\U0010ffff"]
+    assert kv.delete_prefix("\U0010ffff") == 1
+    assert list(kv.scan(prefix="\U0010ffff")) == []
+
+
+def test_value_indexes(tmp_path):
+    db = str(tmp_path / "kv.db")
+    kv = KV(db, batch_size=2)
+    kv.set_many({
+        f"job:{i}": {"status": "failed" if i % 3 else "ok", "n": i}
+        for i in range(10)
+    })
+    kv["scalar"] = 1
+    kv.create_index("status")
+    kv.create_index("retries", path="$.meta.retries")
+    kv["job:10"] = {"status": "ok", "meta": {"retries": None}}
+
+    failed = [key for key, _ in kv.where(status="failed")]
+    assert failed == sorted(f"job:{i}" for i in range(10) if i % 3)
+    assert dict(kv.where(status="ok"))["job:3"] == {"status": "ok", "n": 3}
+    assert [k for k, _ in KV(db).where(status="ok", retries=None)] == [
+        "job:0",
+        "job:10",
+        "job:3",
+        "job:6",
+        "job:9",
+    ]
+    plan = " ".join(
+        str(row)
+        for row in kv._execute(
+            "EXPLAIN QUERY PLAN "
+            + kv._sql.where.format(
+                " AND json_extract(value, '$.status') IS ? AND key > ?"
+            ),
+            ("failed", "", 10),
+        )
+    )
+    assert "kv_status" in plan
+
+    with raises(KeyError):
+        list(kv.where(missing=1))
+    kv.drop_index("retries")
+    with raises(KeyError):
+        list(kv.where(retries=None))
+    with raises(ValueError):
+        KV(codec="pickle").create_index("status")
+
+
+def test_where_empty_key():
+    kv = KV(batch_size=1)
+    kv.set_many({"": {"n": 1}, "a": {"n": 1}, "b": {"n": 2}})
+    kv.create_index("n")
+    assert [key for key, _ in kv.where(n=1)] == ["", "a"]
+
+
+def test_cas(kv: KV):
+    with raises(KeyError):
+        kv.get_versioned("a")
+    assert kv.cas("a", 0, "first")
+    assert not kv.cas("a", 0, "again")
+    value, version = kv.get_versioned("a")
+    assert (value, version) == ("first", 1)
+    kv["a"] = "second"
+    assert not kv.cas("a", version, "stale")
+    assert kv.get_versioned("a") == ("second", 2)
+    assert kv.cas("a", 2, "third")
+    kv.set("gone", 1, ttl=-1)
+    assert kv.cas("gone", 0, "back")
+    assert kv["gone"] == "back"
+
+
+def test_transform(tmp_path):
+    db = str(tmp_path / "kv.db")
+    KV(db, profile="fast")["n"] = {"hits": 0}
+
+    def bump(_: int):
+        kv = KV(db, profile="fast", timeout=30)
+        for _ in range(20):
+            kv.transform("n", lambda v: {"hits": v["hits"] + 1}, retries=100)
+
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(bump, range(4)))
+    assert KV(db)["n"] == {"hits": 80}
+
+
+def test_transform_gives_up():
+    kv = KV(default=0)
+
+    def meddle(value: int) -> int:
+        kv["n"] = value + 100
+        return value + 1
+
+    with raises(ConflictError):
+        kv.transform("n", meddle, retries=2)
+
+
+def test_version_migration(tmp_path):
+    db = str(tmp_path / "kv.db")
+    con = sqlite3.connect(db)
+    con.execute("CREATE TABLE kv (key PRIMARY KEY, value)")
+    con.execute("INSERT INTO kv VALUES ('a', '1')")
+    con.commit()
+    kv = KV(db, default=0)
+    assert kv.get_versioned("a") == (1, 1)
+    kv.incr("a")
+    assert kv.get_versioned("a") == (2, 2)
+
+
+def test_changes():
+    kv = KV(changelog=100, batch_size=2)
+    kv.set_many({"a": 1, "b": 2, "c": 3})
+    seq = kv.change_seq()
+    kv.incr("a")
+    kv["d"] = 4
+    del kv["b"]
+    kv.incr("a")
+    changes = [c for batch in kv.changes(seq) for c in batch]
+    assert [(c.key, c.value, c.deleted) for c in changes] == [
+        ("d", 4, False),
+        ("b", None, True),
+        ("a", 3, False),
+    ]
+    assert changes[-1].seq == kv.change_seq()
+    # one row per key, the log doesn't grow with the number of writes
+    [[n]] = kv._execute("SELECT COUNT(*) FROM kv_changes")
+    assert n == 4
+    assert [c.key for [c] in kv.changes(seq, prefix="d")] == ["d"]
+    with raises(ValueError):
+        KV().changes()
+
+
+def test_changes_retention():
+    kv = KV(changelog=3, purge_every=0)
+    kv.set_many({f"k{i}": i for i in range(10)})
+    assert kv.trim_changes() == 7
+    assert [c.key for batch in kv.changes(7) for c in batch] == [
+        "k7",
+        "k8",
+        "k9",
+    ]
+    with raises(ChangesLost):
+        list(kv.changes(0))
+
+
+def test_watch(tmp_path):
+    kv = KV(str(tmp_path / "kv.db"), changelog=1000)
+    kv["job:old"] = 0
+    seen = []
+    stop = kv.watch("job:", seen.append, interval=0.01)
+    kv["job:1"] = 1
+    kv["other"] = 2
+    kv.incr("job:1")
+    for _ in range(100):
+        if seen and seen[-1].value == 2:
+            break
+        time.sleep(0.01)
+    stop.set()
+    assert [c.key for c in seen] == ["job:1"] * len(seen)
+    assert seen[-1].value == 2
+
+
+def test_watch_survives_errors(tmp_path, caplog):
+    kv = KV(str(tmp_path / "kv.db"), changelog=2)
+    kv.set_many({f"k{i}": i for i in range(5)})
+    kv.trim_changes()
+    seen = []
+
+    def callback(change):
+        if change.key == "bad":
+            raise RuntimeError
+        seen.append(change.key)
+
+    # the changes since 0 were trimmed, it skips ahead
+    stop = kv.watch(None, callback, interval=0.01, since=0)
+    time.sleep(0.05)
+    kv["bad"] = 1
+    time.sleep(0.05)
+    kv["good"] = 1
+    for _ in range(100):
+        if seen:
+            break
+        time.sleep(0.01)
+    stop.set()
+    assert seen == ["good"]
+    messages = [record.message for record in caplog.records]
+    assert "watch lost changes, skipping ahead" in messages
+    assert "watch callback failed" in messages
+
+
+def test_to_frame():
+    kv = KV(batch_size=2)
+    kv["job:1"] = {"status": "ok", "n": 1}
+    kv["job:2"] = {"status": "failed", "n": 2, "extra": [1]}
+    kv["other"] = 3
+    df = kv.to_frame(prefix="job:", columns=["status", "n"])
+    assert df.index.tolist() == ["job:1", "job:2"]
+    assert df["status"].tolist() == ["ok", "failed"]
+    assert df["n"].tolist() == [1, 2]
+    df = kv.to_frame()
+    assert df.loc["other", "value"] == 3
+    assert df.loc["job:2", "extra"] == [1]
+    chunks = list(kv.to_frame(chunksize=2))
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    assert KV().to_frame(columns=["a"]).empty
+
+
+def test_to_frame_columns_match_decoding():
+    kv = KV()
+    kv["a"] = {"n": 1, "ok": True, "nested": {"x": 1}, "value": "v"}
+    kv["b"] = {"n": 2, "ok": False, "nested": [1, 2]}
+    kv["c"] = 3
+    columns = ["n", "ok", "nested", "value"]
+    df = kv.to_frame(columns=columns)
+    assert df["ok"].tolist()[:2] == [True, False]
+    assert df["nested"].tolist()[:2] == [{"x": 1}, [1, 2]]
+    assert df.loc["c", "value"] == 3
+    pd.testing.assert_frame_equal(df, kv.to_frame()[columns])
+
+
+def test_from_frame():
+    df = pd.DataFrame({
+        "id": ["a", "b", "c"],
+        "x": [1, 2, 3],
+        "y": ["p", "q", None],
+    })
+    kv = KV()
+    assert kv.from_frame(df, key_col="id", chunksize=2) == 3
+    assert kv["b"] == {"x": 2, "y": "q"}
+    assert kv["c"] == {"x": 3, "y": None}
+    kv.from_frame(df.set_index("id"), value_cols="x")
+    assert kv.dict() == {"a": 1, "b": 2, "c": 3}
+    kv = KV(codec="pickle")
+    kv.from_frame(df, key_col="id", value_cols=["x"])
+    assert kv["a"] == {"x": 1}
+    assert kv.to_frame(columns=["x"])["x"].tolist() == [1, 2, 3]
+    df = pd.DataFrame(
+        {"x": [1 / 3, 0.1 + 0.2, float("nan")]}, index=["a", "b", "c"]
+    )
+    kv = KV()
+    kv.from_frame(df, value_cols=["x"])
+    assert kv.dict() == {
+        "a": {"x": 1 / 3},
+        "b": {"x": 0.1 + 0.2},
+        "c": {"x": None},
+    }
+    # single column, default index, timestamps
+    kv = KV()
+    kv.from_frame(df.reset_index(drop=True), value_cols="x")
+    assert kv.dict() == {"0": 1 / 3, "1": 0.1 + 0.2, "2": None}
+    df = pd.DataFrame({
+        "at": pd.to_datetime(["2024-01-02 03:04:05", None]),
+        "n": [1, 2],
+    })
+    kv.from_frame(df)
+    assert kv["0"] == {"at": "2024-01-02T03:04:05", "n": 1}
+    assert kv["1"] == {"at": None, "n": 2}
+    kv.from_frame(df, value_cols="at")
+    assert kv.get_many(["0", "1"]) == {"0": "2024-01-02T03:04:05", "1": None}
+
+
+def test_snapshot_and_readonly(tmp_path):
+    kv = KV(str(tmp_path / "kv.db"), codec="pickle")
+    kv.set_many({f"k{i}": i for i in range(1000)})
+    calls = []
+    kv.snapshot(
+        str(tmp_path / "copy.db"),
+        pages=2,
+        progress=lambda *args: calls.append(args),
+    )
+    assert len(calls) > 1
+    for immutable in [False, True]:
+        copy = KV.open_readonly(
+            str(tmp_path / "copy.db"), immutable=immutable
+        )
+        assert copy["k10"] == 10
+        assert len(copy) == 1000
+        assert copy.profile()["mmap_size"] == 1 << 30
+        with raises(sqlite3.OperationalError):
+            copy["k10"] = 0
+    with raises(ValueError):
+        KV.open_readonly(str(tmp_path / "copy.db"), table="other")
+
+
+def test_compact(tmp_path):
+    kv = KV(str(tmp_path / "kv.db"))
+    kv.set_many({f"k{i}": "x" * 1000 for i in range(1000)})
+    kv.delete_prefix("k")
+    assert kv.compact() > 0
+    assert kv.stats()["freelist_count"] == 0
+    kv.set_many({f"k{i}": "x" * 1000 for i in range(1000)})
+    kv.delete_prefix("k")
+    assert kv.compact(pages=10) > 0
+    assert kv.stats()["freelist_count"] == 0
+
+
+def test_clone_shares_connection(tmp_path):
+    kv = KV(str(tmp_path / "kv.db"), default=0, timeout=1)
+    other = kv.clone("other")
+    assert other._db is kv._db
+    assert other["missing"] == 0
+    assert other._timeout == 1
+    with raises(RuntimeError):
+        with kv.lock():
+            kv["a"] = 1
+            other["a"] = 1
+            raise RuntimeError
+    assert kv.dict() == other.dict() == {}
+
+
+def test_store(tmp_path):
+    store = KVStore(str(tmp_path / "kv.db"), default=0)
+    users, jobs = store["users"], store.kv("jobs", default=None)
+    assert store["users"] is users
+    assert users._db is jobs._db
+    assert users["missing"] == 0
+    with raises(KeyError):
+        jobs["missing"]
+    with store.transaction():
+        users["a"] = {"name": "a"}
+        jobs["1"] = {"user": "a"}
+    with raises(RuntimeError):
+        with store.transaction():
+            users["b"] = {"name": "b"}
+            with jobs.lock():
+                jobs["2"] = {"user": "b"}
+            raise RuntimeError
+    assert users.dict() == {"a": {"name": "a"}}
+    assert jobs.dict() == {"1": {"user": "a"}}
+    assert "jobs" in store
+    assert "nope" not in store
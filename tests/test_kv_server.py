@@ -0,0 +1,140 @@
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from pytest import fixture, raises
+
+from utilki import KV, KVServer, RemoteKV
+from utilki.kv_server import _dumps, _loads
+
+
+@fixture
+def server(tmp_path):
+    server = KVServer(str(tmp_path / "kv.db"), default=0).start()
+    yield server
+    server.stop()
+
+
+def test_remote_ops(server):
+    with RemoteKV(port=server.port) as kv:
+        kv["a"] = {"n": 1}
+        kv.set_many({"b": 2, "c": 3})
+        assert kv["a"] == {"n": 1}
+        assert kv["missing"] == 0
+        assert kv.incr("b", 5) == 7
+        assert kv.get_many(["b", "c"]) == {"b": 7, "c": 3}
+        assert kv.delete_many(["c"]) == 1
+        assert "b" in kv
+        del kv["a"]
+        with raises(KeyError):
+            del kv["a"]
+        assert len(kv) == 1
+        assert list(kv) == ["b"]
+        assert kv.dict() == {"b": 7}
+        kv.hits += 1
+        kv.hits += 1
+        assert kv["hits"] == 2
+
+
+def test_remote_scan_where_transform(tmp_path):
+    db = str(tmp_path / "kv.db")
+    KV(db).create_index("status")
+    server = KVServer(db).start()
+    try:
+        with RemoteKV(port=server.port) as kv:
+            kv.set_many({f"job:{i:02}": {"status": i % 2} for i in range(30)})
+            kv["other"] = 1
+            keys = [key for key, _ in kv.scan("job:", n=7)]
+            assert keys == [f"job:{i:02}" for i in range(30)]
+            assert [key for key, _ in kv.scan("job:", limit=3)] == [
+                "job:00",
+                "job:01",
+                "job:02",
+            ]
+            backwards = kv.scan(start="job:1", reverse=True, limit=12, n=5)
+            assert [key for key, _ in backwards][::5] == [
+                "other",
+                "job:25",
+                "job:20",
+            ]
+            odd = [key for key, _ in kv.where(status=1)]
+            assert odd == [f"job:{i:02}" for i in range(1, 30, 2)]
+            with raises(KeyError):
+                list(kv.where(missing=1))
+            assert kv.transform("other", lambda n: n + 1) == 2
+            # items() and values() page, no round trip per key
+            calls = []
+
+            def call(op, *args):
+                calls.append(op)
+                return RemoteKV._call(kv, op, *args)
+
+            kv._call = call
+            assert dict(kv.items())["other"] == 2
+            assert len(list(kv.values())) == 31
+            assert set(calls) == {"page"}
+    finally:
+        server.stop()
+
+
+def test_unix_socket(tmp_path):
+    path = str(tmp_path / "kv.sock")
+    server = KVServer(
+        str(tmp_path / "kv.db"), path=path, codec="pickle"
+    ).start()
+    try:
+        with RemoteKV(path) as kv:
+            kv["a"] = b"bytes"
+            assert kv["a"] == b"bytes"
+    finally:
+        server.stop()
+    assert KV(str(tmp_path / "kv.db"))["a"] == b"bytes"
+
+
+def test_pipeline(server):
+    with RemoteKV(port=server.port) as kv:
+        with kv.pipeline() as p:
+            for _ in range(100):
+                p.incr("n")
+            p.get("n")
+            p.delete("missing")
+        assert p.results[99:101] == [100, 100]
+        assert isinstance(p.results[-1], KeyError)
+
+
+def test_many_clients(server):
+    def work(_):
+        with RemoteKV(port=server.port) as kv:
+            for _ in range(50):
+                kv.incr("n")
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(work, range(8)))
+    with RemoteKV(port=server.port) as kv:
+        assert kv["n"] == 400
+
+
+def test_lock_and_cas(server):
+    with RemoteKV(port=server.port) as kv:
+        kv["a"] = 1
+        with kv.lock(default=10):
+            assert kv["missing"] == 10
+            kv["a"] = 2
+        with raises(RuntimeError):
+            with kv.lock():
+                kv["a"] = 100
+                raise RuntimeError
+        assert kv["a"] == 2
+        value, version = kv.get_versioned("a")
+        assert kv.cas("a", version, value + 1)
+        assert not kv.cas("a", version, 0)
+        assert kv["a"] == 3
+
+
+def test_refuses_arbitrary_objects():
+    assert _loads(_dumps({"a": [1, (2, b"3")], "b": {4.0}})) == {
+        "a": [1, (2, b"3")],
+        "b": {4.0},
+    }
+    with raises(pickle.UnpicklingError):
+        _loads(_dumps(datetime(2024, 1, 1)))
@@ -0,0 +1,123 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from pytest import raises
+
+from utilki import KV
+from utilki.limits import parse_rate
+
+
+def test_parse_rate():
+    assert parse_rate(5) == (5.0, 1.0)
+    assert parse_rate("50/s") == (50.0, 1.0)
+    assert parse_rate("100/m") == (100.0, 60.0)
+    assert parse_rate("5/10s") == (5.0, 10.0)
+    with raises(ValueError):
+        parse_rate("fast")
+
+
+def test_token_bucket():
+    kv = KV()
+    # slow enough that a stalled test doesn't get a token back in between
+    slow = kv.rate_limit("slow", "1/m", burst=5)
+    assert all(slow.acquire(blocking=False) for _ in range(5))
+    assert not slow.acquire(blocking=False)
+    assert not slow.acquire(timeout=0)
+    limiter = kv.rate_limit("api", "100/s", burst=5)
+    assert kv.rate_limit("api", "100/s", burst=5) is limiter
+    start = time.monotonic()
+    for _ in range(15):
+        with limiter:
+            pass
+    assert time.monotonic() - start >= 0.09
+    with raises(ValueError):
+        limiter.acquire(10)
+
+
+def test_sliding_window():
+    kv = KV()
+    limiter = kv.rate_limit("api", "3/0.1s", algorithm="sliding_window")
+    assert [limiter.acquire(blocking=False) for _ in range(4)] == [
+        True,
+        True,
+        True,
+        False,
+    ]
+    start = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - start > 0.01
+    with raises(ValueError):
+        kv.rate_limit("api", 1, algorithm="leaky")
+
+
+def test_async_rate_limit(tmp_path):
+    db = str(tmp_path / "kv.db")
+    for kv in [KV(), KV(db), KV(db, threadsafe=True)]:
+        limiter = kv.rate_limit("api", "20/s", burst=1)
+        lease = kv.lease("deploy")
+
+        async def main():
+            start = time.monotonic()
+            await limiter
+            await limiter
+            async with limiter:
+                pass
+            async with lease:
+                assert not await kv.lease("deploy").acquire_async(
+                    blocking=False
+                )
+            return time.monotonic() - start
+
+        statements: list[str] = []
+        kv._db.set_trace_callback(statements.append)
+        assert asyncio.run(main()) >= 0.09
+        kv._db.set_trace_callback(None)
+        # the loop's own connection only ran release()
+        if kv._db_uri != ":memory:":
+            assert all("DELETE" in sql for sql in statements)
+        assert not lease.locked()
+
+
+def test_lease():
+    kv = KV()
+    first, second = kv.lease("deploy", ttl=0.1), kv.lease("deploy")
+    assert first.acquire()
+    assert first.locked()
+    assert not second.acquire(blocking=False)
+    assert first.acquire(blocking=False)  # already held, renews
+    assert first.renew()
+    # the holder crashed, the lease runs out
+    assert second.acquire(timeout=1)
+    assert not first.renew()
+    assert not first.release()
+    assert second.release()
+    assert not second.locked()
+    with kv.lease("deploy"):
+        with raises(TimeoutError):
+            with kv.lease("deploy", timeout=0.01):
+                pass
+    assert kv.lease("deploy").acquire(blocking=False)
+
+
+def _launch(db: str) -> list[float]:
+    kv = KV(db, profile="fast", timeout=30)
+    limiter = kv.rate_limit("launch", "200/s", burst=10)
+    times = []
+    for _ in range(20):
+        with limiter:
+            times.append(time.time())
+    return times
+
+
+def test_rate_limit_across_processes(tmp_path):
+    db = str(tmp_path / "kv.db")
+    KV(db, profile="fast")
+    spawn = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(4, mp_context=spawn) as pool:
+        times = sorted(
+            t for part in pool.map(_launch, [db] * 4) for t in part
+        )
+    # 80 launches at 200/s with a burst of 10 take at least 0.35s
+    assert times[-1] - times[0] >= 0.3
@@ -0,0 +1,146 @@
+import threading
+import time
+
+from pytest import raises
+
+from utilki import KV
+
+
+def test_memoize(tmp_path):
+    db = str(tmp_path / "kv.db")
+    calls = []
+
+    def add(a, b=1):
+        calls.append((a, b))
+        return {"sum": a + b}
+
+    cached = KV(db).memoize(add)
+    assert cached(1) == {"sum": 2}
+    assert cached(1, b=1) == {"sum": 2}
+    assert cached(a=1, b=1) == {"sum": 2}
+    assert cached(2, 3) == {"sum": 5}
+    assert calls == [(1, 1), (2, 3)]
+    info = cached.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (2, 2, 2)
+    # survives reopening the db
+    assert KV(db).memoize(add)(2, 3) == {"sum": 5}
+    assert len(calls) == 2
+    cached.cache_clear()
+    assert cached.cache_info().currsize == 0
+    assert cached(1) == {"sum": 2}
+    assert len(calls) == 3
+
+
+def test_memoize_unusual_arguments():
+    kv = KV(codec="pickle")
+
+    @kv.memoize
+    def f(*args, **kwargs):
+        return args, kwargs
+
+    assert f({1, 2}, b"x", when=3.5) == (({1, 2}, b"x"), {"when": 3.5})
+    assert f({2, 1}, b"x", when=3.5) == (({1, 2}, b"x"), {"when": 3.5})
+    assert f.cache_info().hits == 1
+    f((1, 2)), f([1, 2]), f({(1, 2): 1}), f({1: 2})
+    assert f([1, 2]) == (([1, 2],), {})
+    assert f.cache_info().misses == 5
+
+
+def test_memoize_hits_dont_write():
+    kv = KV()
+
+    @kv.memoize(max_entries=2)
+    def f(x):
+        return x
+
+    f(1), f(2)
+    statements: list[str] = []
+    kv._db.set_trace_callback(statements.append)
+    assert [f(1), f(2), f(1)] == [1, 2, 1]
+    assert not [sql for sql in statements if not sql.startswith("SELECT")]
+    f(3)
+    [[hits]] = kv._execute(
+        "SELECT hits FROM kv_memo WHERE key=?", (f.key(1),)
+    )
+    assert hits == 2
+
+
+def test_memoize_ttl():
+    kv = KV()
+    calls = []
+
+    @kv.memoize(ttl=-1)
+    def f(x):
+        calls.append(x)
+        return x
+
+    assert f(1) == f(1) == 1
+    assert calls == [1, 1]
+    # expired results are purged when new ones are stored
+    assert f.cache_info().currsize == 0
+
+
+def test_memoize_eviction():
+    kv = KV()
+
+    @kv.memoize(max_entries=2)
+    def lru(x):
+        return x
+
+    lru(1), lru(2), lru(1), lru(3)
+    keys = {lru.key(x) for x in [1, 3]}
+    assert {key for [key] in kv._execute("SELECT key FROM kv_memo")} == keys
+
+    @kv.memoize(max_entries=2, policy="lfu")
+    def lfu(x):
+        return x
+
+    lfu(1), lfu(1), lfu(1), lfu(2), lfu(2), lfu(3)
+    lfu(4)
+    assert lfu.cache_info().currsize == 2
+    hits = lfu.cache_info().hits
+    lfu(1), lfu(2)
+    assert lfu.cache_info().hits == hits + 1
+
+    @kv.memoize(max_bytes=10)
+    def big(x):
+        return "x" * x
+
+    big(4), big(5), big(6)
+    assert big.cache_info().nbytes <= 10
+    with raises(ValueError):
+        kv.memoize(policy="fifo")(big)
+
+
+def test_memoize_failure_releases_lease():
+    kv = KV()
+
+    @kv.memoize
+    def fail():
+        raise RuntimeError
+
+    with raises(RuntimeError):
+        fail()
+    with raises(RuntimeError):
+        fail()
+    [[n]] = kv._execute("SELECT COUNT(*) FROM kv_memo")
+    assert n == 0
+
+
+def test_memoize_dedupes_concurrent_calls(tmp_path):
+    kv = KV(str(tmp_path / "kv.db"), threadsafe=True)
+    calls = []
+
+    @kv.memoize
+    def slow(x):
+        calls.append(x)
+        time.sleep(0.1)
+        return x
+
+    threads = [threading.Thread(target=slow, args=(1,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == [1]
+    assert slow.cache_info().hits == 7
@@ -0,0 +1,57 @@
+from pytest import raises
+
+from utilki import ShardedKV
+
+
+def test_mapping_api(tmp_path):
+    db = str(tmp_path / "kv.db")
+    kv = ShardedKV(db, shards=4, default=0)
+    for i in range(50):
+        kv[f"k{i:02}"] = i
+    assert len(kv) == 50
+    assert kv["k07"] == 7
+    assert kv["missing"] == 0
+    del kv["k07"]
+    assert list(kv)[:3] == ["k00", "k01", "k02"]
+    assert list(kv) == sorted(kv)
+    assert sum(1 for shard in kv.shards if len(shard)) > 1
+    assert ShardedKV(db, shards=4).dict() == kv.dict()
+    with raises(ValueError):
+        ShardedKV(db, shards=3)
+
+
+def test_batch_ops():
+    kv = ShardedKV(shards=3, default=0)
+    kv.set_many({f"k{i}": i for i in range(20)})
+    assert kv.get_many(["k1", "k5", "nope"]) == {"k1": 1, "k5": 5, "nope": 0}
+    assert kv.incr_many({"k1": 1, "x": 2}) == {"k1": 2, "x": 2}
+    kv.hits += 1  # type: ignore
+    kv.hits += 1  # type: ignore
+    assert kv["hits"] == 2
+    assert kv.delete_many(["k1", "k2", "nope"]) == 2
+    assert len(kv) == 20
+
+
+def test_scan_is_merged_in_order():
+    kv = ShardedKV(shards=4)
+    kv.set_many({f"job:{i:03}": i for i in range(100)})
+    kv["other"] = 1
+    keys = [key for key, _ in kv.scan(prefix="job:")]
+    assert keys == [f"job:{i:03}" for i in range(100)]
+    assert [k for k, _ in kv.scan(prefix="job:", reverse=True, limit=2)] == [
+        "job:099",
+        "job:098",
+    ]
+    assert kv.delete_prefix("job:") == 100
+    assert list(kv) == ["other"]
+
+
+def test_lock():
+    kv = ShardedKV(shards=2)
+    kv.set_many({"a": 1, "b": 2})
+    with raises(RuntimeError):
+        with kv.lock():
+            kv["a"] = 10
+            kv["b"] = 20
+            raise RuntimeError
+    assert kv.dict() == {"a": 1, "b": 2}
@@ -0,0 +1,94 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from utilki import KVStore, Queue
+
+
+def test_put_claim_ack():
+    q = Queue()
+    q.put("low")
+    q.put_many(["a", "b", "c"], priority=5)
+    assert len(q) == 4
+    jobs = q.claim(batch=3)
+    assert [job.value for job in jobs] == ["a", "b", "c"]
+    assert q.ready() == 1
+    assert q.ack(jobs[:2]) == 2
+    assert q.nack(jobs[2]) == 1
+    assert [job.value for job in q.claim(batch=10)] == ["c", "low"]
+    assert q.claim() == []
+
+
+def test_claim_skips_invisible_jobs():
+    q = Queue()
+    [plan] = [
+        row[3]
+        for row in q._execute("EXPLAIN QUERY PLAN " + q._sql.claim, (1, 1))
+        if "visible_at<?" in row[3]
+    ]
+    assert "priority=? AND visible_at<?" in plan
+    q.put_many(["leased", "delayed"], priority=9)
+    q.claim()
+    q.nack(q.claim(), delay=10)
+    q.put_many(["a", "b"])
+    [a] = q.claim()
+    time.sleep(0.01)
+    q.nack(a)
+    q.put("x", priority=3)
+    # a went back after b became ready
+    assert [job.value for job in q.claim(batch=2)] == ["x", "b"]
+
+
+def test_visibility_timeout():
+    q = Queue(lease=0.05)
+    q.put({"n": 1})
+    [job] = q.claim()
+    assert q.claim() == []
+    time.sleep(0.06)
+    [again] = q.claim()
+    assert again.id == job.id and again.attempts == 2
+    # the first worker's lease ran out, its ack doesn't count
+    assert q.ack(job) == 0
+    assert q.extend(again, lease=10) == 1
+    time.sleep(0.06)
+    assert q.claim() == []
+    assert q.ack(again) == 1
+    assert len(q) == 0
+
+
+def test_delay():
+    q = Queue()
+    q.put("later", delay=0.05)
+    q.nack([], delay=1)
+    assert q.claim() == []
+    time.sleep(0.06)
+    assert [job.value for job in q.claim()] == ["later"]
+
+
+def test_store_queue(tmp_path):
+    store = KVStore(str(tmp_path / "kv.db"))
+    q = store.queue("jobs")
+    kv = store["kv"]
+    with store.transaction():
+        q.put("a")
+        kv["queued"] = 1
+    assert len(q) == 1
+    assert Queue(str(tmp_path / "kv.db"), "jobs").claim()[0].value == "a"
+
+
+def _work(db: str) -> list[int]:
+    q = Queue(db, profile="fast", timeout=30)
+    done = []
+    while jobs := q.claim(batch=50):
+        q.ack(jobs)
+        done += [job.value for job in jobs]
+    return done
+
+
+def test_many_processes(tmp_path):
+    db = str(tmp_path / "q.db")
+    Queue(db, profile="fast").put_many(range(2000))
+    spawn = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(4, mp_context=spawn) as pool:
+        done = [n for part in pool.map(_work, [db] * 4) for n in part]
+    assert sorted(done) == list(range(2000))
@@ -4,4 +4,10 @@ __version__ = "0.1.0"
 
 from .task_mixin import TaskMixin  # type: ignore
 from .log_utils import *  # type: ignore
-from .kv import KV  # type: ignore
+from .kv import KV, ChangesLost, ConflictError, KVStore  # type: ignore
+from .async_kv import AsyncKV  # type: ignore
+from .buffered import BufferedKV  # type: ignore
+from .codec import Codec  # type: ignore
+from .sharded import ShardedKV  # type: ignore
+from .kv_server import KVServer, RemoteKV  # type: ignore
+from .work_queue import Job, Queue  # type: ignore
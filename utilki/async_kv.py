@@ -0,0 +1,278 @@
+"""
+asyncio front end for KV
+
+reads run on a small thread pool, writes go to a single writer thread.
+writes that pile up while the writer is busy are committed together in one
+transaction, each in its own savepoint so one failing write doesn't take
+the others down with it. inside `async with akv.lock()` every operation of
+the holding task runs on the writer thread in the lock's transaction, and
+writes from other tasks wait until it commits.
+"""
+
+import asyncio
+import queue
+import threading
+from collections import deque
+from collections.abc import AsyncIterator, Callable, Iterable, Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any
+
+from .kv import KV
+
+
+class _Rollback(Exception):
+    pass
+
+
+# markers for lock() enter/exit, handled by the writer loop itself
+_BEGIN = object()
+_END = object()
+
+
+class _Op:
+    __slots__ = ("fn", "args", "future", "token")
+
+    def __init__(self, fn: Any, args: tuple[Any, ...], token):
+        self.fn = fn
+        self.args = args
+        self.future: Future[Any] = Future()
+        self.token = token
+
+
+class AsyncKV:
+    def __init__(
+        self,
+        *args: Any,
+        readers: int = 4,
+        max_batch: int = 1000,
+        **kwargs: Any,
+    ):
+        kwargs["threadsafe"] = True
+        self.kv = KV(*args, **kwargs)
+        self.max_batch = max_batch
+        self._queue: queue.SimpleQueue[_Op | None] = queue.SimpleQueue()
+        self._readers = ThreadPoolExecutor(
+            readers, thread_name_prefix="AsyncKV-reader"
+        )
+        self._writer = threading.Thread(
+            target=self._write_loop, name="AsyncKV-writer", daemon=True
+        )
+        self._writer.start()
+        # token of the lock() the current task is inside of, if any
+        self._token: ContextVar[object | None] = ContextVar(
+            f"AsyncKV-{id(self)}", default=None
+        )
+        self._mutex: asyncio.Lock | None = None
+
+    async def _write(self, fn: Callable[..., Any], *args: Any) -> Any:
+        op = _Op(fn, args, self._token.get())
+        self._queue.put(op)
+        return await asyncio.wrap_future(op.future)
+
+    async def _read(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if self._token.get() is not None:
+            # must see the lock's uncommitted writes and default
+            return await self._write(fn, *args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, fn, *args)
+
+    def _write_loop(self):
+        kv = self.kv
+        owner = None
+        held = None
+        deferred: deque[_Op] = deque()
+        while True:
+            if owner is None and deferred:
+                op = deferred.popleft()
+            else:
+                op = self._queue.get()
+            if op is None:
+                break
+            if owner is not None and op.token is not owner:
+                deferred.append(op)
+                continue
+            if op.fn is _END:
+                # runs even if its caller was cancelled, it frees the lock
+                op.future.set_running_or_notify_cancel()
+                if owner is None or op.token is not owner:
+                    # the _BEGIN was cancelled or failed, nothing to release
+                    _run(op, lambda: None)
+                    continue
+                [failed] = op.args
+                exc = (
+                    (_Rollback, _Rollback(), None) if failed else (None,) * 3
+                )
+                owner = None
+                _run(op, _exit, held, exc)
+                continue
+            if not op.future.set_running_or_notify_cancel():
+                # cancelled while it was queued
+                continue
+            if op.fn is _BEGIN:
+                held = kv.lock(*op.args)
+                if _run(op, held.__enter__):
+                    owner = op.token
+                continue
+            if owner is not None:
+                _run(op, op.fn, *op.args)
+                continue
+            group = [op]
+            while len(group) < self.max_batch:
+                try:
+                    more = (
+                        deferred.popleft()
+                        if deferred
+                        else self._queue.get_nowait()
+                    )
+                except (IndexError, queue.Empty):
+                    break
+                if more is None or more.fn in (_BEGIN, _END):
+                    deferred.appendleft(more)  # type: ignore
+                    break
+                if more.future.set_running_or_notify_cancel():
+                    group.append(more)
+            self._commit(group)
+        self.kv._pool.conn.db.close()
+
+    def _commit(self, group: list[_Op]):
+        kv = self.kv
+        results: list[tuple[bool, Any]] = []
+        try:
+            with kv.lock():
+                for op in group:
+                    kv._execute("SAVEPOINT async_kv_op")
+                    try:
+                        results.append((True, op.fn(*op.args)))
+                    except Exception as e:
+                        kv._execute("ROLLBACK TO async_kv_op")
+                        kv._pool.clear_caches()
+                        results.append((False, e))
+                    kv._execute("RELEASE async_kv_op")
+        except Exception as e:
+            for op in group:
+                op.future.set_exception(e)
+            return
+        # only report success once the group is committed
+        for op, (ok, result) in zip(group, results):
+            if ok:
+                op.future.set_result(result)
+            else:
+                op.future.set_exception(result)
+
+    async def get(self, key: str) -> Any:
+        return await self._read(self.kv.__getitem__, key)
+
+    async def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        return await self._read(self.kv.get_many, list(keys))
+
+    async def contains(self, key: str) -> bool:
+        return await self._read(self.kv.__contains__, key)
+
+    async def len(self) -> int:
+        return await self._read(self.kv.__len__)
+
+    async def set(self, key: str, value: Any, ttl: float | None = None):
+        await self._write(self.kv.set, key, value, ttl)
+
+    async def set_many(
+        self,
+        items: Mapping[str, Any] | Iterable[tuple[str, Any]],
+        ttl: float | None = None,
+    ):
+        if isinstance(items, Mapping):
+            items = items.items()
+        await self._write(self.kv.set_many, list(items), ttl)
+
+    async def delete(self, key: str):
+        await self._write(self.kv.__delitem__, key)
+
+    async def delete_many(self, keys: Iterable[str]) -> int:
+        return await self._write(self.kv.delete_many, list(keys))
+
+    async def incr(self, key: str, amount: int = 1) -> int:
+        return await self._write(self.kv.incr, key, amount)
+
+    async def decr(self, key: str, amount: int = 1) -> int:
+        return await self._write(self.kv.decr, key, amount)
+
+    async def incr_many(self, amounts: Mapping[str, int]) -> dict[str, int]:
+        return await self._write(self.kv.incr_many, dict(amounts))
+
+    async def items(
+        self, batch_size: int | None = None
+    ) -> AsyncIterator[tuple[str, Any]]:
+        batches = self.kv.iter_batches(batch_size)
+        while batch := await self._read(next, batches, None):
+            for item in batch:
+                yield item
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        async for key, _ in self.items():
+            yield key
+
+    async def dict(self) -> dict[str, Any]:
+        return {key: value async for key, value in self.items()}
+
+    @asynccontextmanager
+    async def lock(self, default: Any = None):
+        if self._token.get() is not None:
+            # nested, already inside the transaction
+            yield self
+            return
+        if self._mutex is None:
+            self._mutex = asyncio.Lock()
+        async with self._mutex:
+            token = object()
+            reset = self._token.set(token)
+            try:
+                await self._write(_BEGIN, default)
+            except BaseException:
+                # cancelled while the _BEGIN was queued or running: if the
+                # writer still takes the lock, this releases it again
+                self._queue.put(_Op(_END, (True,), token))
+                self._token.reset(reset)
+                raise
+            failed = False
+            try:
+                yield self
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                await self._write(_END, failed)
+                self._token.reset(reset)
+
+    async def close(self):
+        self._queue.put(None)
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._writer.join
+        )
+        self._readers.shutdown(wait=False)
+
+    async def __aenter__(self) -> "AsyncKV":
+        return self
+
+    async def __aexit__(self, *exc: Any):
+        await self.close()
+
+
+def _run(op: _Op, fn: Callable[..., Any], *args: Any) -> bool:
+    # a cancelled _END still runs, but there is nobody to tell
+    try:
+        result = fn(*args)
+    except Exception as e:
+        if op.future.running():
+            op.future.set_exception(e)
+        return False
+    if op.future.running():
+        op.future.set_result(result)
+    return True
+
+
+def _exit(held: Any, exc: tuple[Any, Any, Any]):
+    try:
+        held.__exit__(*exc)
+    except _Rollback:
+        pass
@@ -0,0 +1,229 @@
+"""
+write-behind KV for hot loops
+
+writes and increments are collected in memory, coalesced per key and
+written in one transaction when the buffer fills up, when `flush_interval`
+seconds have passed since the last flush, on `flush()`, or when the
+`with` block exits. reads see buffered values.
+
+the interval is only checked when something is written, there is no
+background thread (the buffers aren't locked, the hot loop owns them). a
+buffer that goes idle keeps its writes until the next write, `flush()`,
+the end of the `with` block or exit, so call `flush()` when a loop pauses.
+
+what is still in the buffer is lost if the process dies, so the data at
+risk is bounded by `max_pending` keys / `flush_interval` seconds of
+writing. how durable a flush itself is depends on the KV `profile`.
+"""
+
+import atexit
+import threading
+import time
+from collections.abc import Iterable, Mapping, MutableMapping
+from contextlib import contextmanager
+from copy import deepcopy
+from typing import Any
+from weakref import WeakValueDictionary
+
+from .kv import _MISS, KV, _copy, _KVMethods
+
+_DELETED = object()
+
+
+# id -> every BufferedKV still alive with flush_at_exit, flushed by one
+# hook (mappings aren't hashable, so no WeakSet)
+_live: "WeakValueDictionary[int, BufferedKV]" = WeakValueDictionary()
+
+
+@atexit.register
+def _flush_at_exit():
+    for kv in list(_live.values()):
+        kv.flush()
+
+
+class BufferedKV(_KVMethods, MutableMapping[str, Any]):
+    def __init__(
+        self,
+        *args: Any,
+        max_pending: int = 10_000,
+        flush_interval: float | None = 1.0,
+        flush_at_exit: bool = True,
+        **kwargs: Any,
+    ):
+        self.kv = KV(*args, **kwargs)
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        # key -> value (or _DELETED) that overwrites whatever is stored
+        self._pending: dict[str, Any] = {}
+        # key -> amount to add in sqlite, plus the value it was added to
+        self._deltas: dict[str, Any] = {}
+        self._bases: dict[str, Any] = {}
+        self._flushed_at = time.monotonic()
+        if flush_at_exit:
+            _live[id(self)] = self
+
+    def flush(self):
+        self._flushed_at = time.monotonic()
+        if not self._pending and not self._deltas:
+            return
+        pending, deltas, bases = self._pending, self._deltas, self._bases
+        self._pending, self._deltas, self._bases = {}, {}, {}
+        try:
+            with self.kv.lock():
+                self.kv.delete_many(
+                    key for key, value in pending.items() if value is _DELETED
+                )
+                self.kv.set_many(
+                    (key, value)
+                    for key, value in pending.items()
+                    if value is not _DELETED
+                )
+                self.kv.incr_many(deltas)
+        except BaseException:
+            self._pending, self._deltas, self._bases = pending, deltas, bases
+            raise
+
+    def _written(self):
+        if len(self._pending) + len(self._deltas) >= self.max_pending or (
+            self.flush_interval is not None
+            and time.monotonic() - self._flushed_at >= self.flush_interval
+        ):
+            self.flush()
+
+    def _missing(self, key: str) -> Any:
+        default = self.kv._default
+        if default is None:
+            raise KeyError(key)
+        return deepcopy(default)
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        if key in self._pending:
+            value = self._pending[key]
+            if value is _DELETED:
+                value = self._missing(key)
+            value += amount
+            self._pending[key] = value
+        elif key in self._deltas:
+            self._deltas[key] += amount
+            value = self._bases[key] + self._deltas[key]
+        else:
+            base = self.kv[key]
+            value = base + amount
+            self._bases[key] = base
+            self._deltas[key] = amount
+        self._written()
+        return value
+
+    def decr(self, key: str, amount: int = 1) -> int:
+        return self.incr(key, -amount)
+
+    def incr_many(self, amounts: Mapping[str, int]) -> dict[str, int]:
+        return {key: self.incr(key, n) for key, n in amounts.items()}
+
+    def set_many(self, items: Mapping[str, Any] | Iterable[tuple[str, Any]]):
+        if isinstance(items, Mapping):
+            items = items.items()
+        for key, value in items:
+            self[key] = value
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        keys = list(keys)
+        stored = self.kv.get_many(
+            key
+            for key in keys
+            if key not in self._pending and key not in self._deltas
+        )
+        found = {}
+        for key in keys:
+            if key in self._pending or key in self._deltas:
+                try:
+                    found[key] = self[key]
+                except KeyError:
+                    pass
+            elif key in stored:
+                found[key] = stored[key]
+        return found
+
+    def delete_many(self, keys: Iterable[str]) -> int:
+        deleted = 0
+        for key in keys:
+            try:
+                del self[key]
+            except KeyError:
+                continue
+            deleted += 1
+        return deleted
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._pending:
+            value = self._pending[key]
+            if value is _DELETED:
+                return self._missing(key)
+            return _copy(value)
+        if key in self._deltas:
+            return self._bases[key] + self._deltas[key]
+        return self.kv[key]
+
+    def __setitem__(self, key: str, value: Any):
+        self._pending[key] = _copy(value)
+        self._deltas.pop(key, None)
+        self._bases.pop(key, None)
+        self._written()
+
+    def __delitem__(self, key: str):
+        value = self._pending.get(key, _MISS)
+        if value is _DELETED:
+            raise KeyError(key)
+        if value is _MISS and key not in self._deltas:
+            [[exists]] = self.kv._execute(
+                f"SELECT EXISTS ({self.kv._sql.get})", (key,)
+            )
+            if not exists:
+                raise KeyError(key)
+        self._pending[key] = _DELETED
+        self._deltas.pop(key, None)
+        self._bases.pop(key, None)
+        self._written()
+
+    def __iter__(self):
+        self.flush()
+        return iter(self.kv)
+
+    def __len__(self):
+        self.flush()
+        return len(self.kv)
+
+    @contextmanager
+    def lock(self, default: Any = None):
+        self.flush()
+        with self.kv.lock(default):
+            try:
+                yield self
+            except BaseException:
+                # the transaction is rolled back, so are the buffered writes
+                self._pending, self._deltas, self._bases = {}, {}, {}
+                raise
+            self.flush()
+
+    def __enter__(self) -> "BufferedKV":
+        return self
+
+    def __exit__(self, *exc: Any):
+        self.flush()
+
+    def dict(self):
+        self.flush()
+        return self.kv.dict()
+
+    def items(self):
+        self.flush()
+        return self.kv.items()
+
+    def values(self):
+        self.flush()
+        return self.kv.values()
+
+    def ratio(self, *args: Any, **kwargs: Any) -> float:
+        self.flush()
+        return self.kv.ratio(*args, **kwargs)
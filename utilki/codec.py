@@ -0,0 +1,165 @@
+"""
+value codecs for KV
+
+a codec turns python values into something sqlite can store (str or bytes)
+and back. codecs with `json = True` store JSON text, which lets KV do
+counters and value indexes inside sqlite with the JSON1 functions.
+"""
+
+import json
+import lzma
+import pickle
+import zlib
+from typing import Any
+
+
+class Codec:
+    name: str = ""
+    json: bool = False
+
+    def encode(self, value: Any) -> str | bytes:
+        raise NotImplementedError
+
+    def decode(self, data: str | bytes) -> Any:
+        raise NotImplementedError
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.name!r})"
+
+
+class JsonCodec(Codec):
+    name = "json"
+    json = True
+
+    def encode(self, value: Any) -> str:
+        return json.dumps(value)
+
+    def decode(self, data: str | bytes) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(Codec):
+    name = "orjson"
+    json = True
+
+    def __init__(self):
+        import orjson
+
+        self._orjson = orjson
+
+    def encode(self, value: Any) -> str:
+        # stored as TEXT so the JSON1 functions keep working on it
+        return self._orjson.dumps(
+            value, option=self._orjson.OPT_SERIALIZE_NUMPY
+        ).decode()
+
+    def decode(self, data: str | bytes) -> Any:
+        return self._orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+
+    def __init__(self):
+        import msgpack
+
+        self._msgpack = msgpack
+
+    def encode(self, value: Any) -> bytes:
+        return self._msgpack.packb(value, use_bin_type=True)
+
+    def decode(self, data: str | bytes) -> Any:
+        return self._msgpack.unpackb(data, raw=False)
+
+
+class PickleCodec(Codec):
+    name = "pickle"
+
+    def encode(self, value: Any) -> bytes:
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data: str | bytes) -> Any:
+        return pickle.loads(data)  # noqa: S301
+
+
+class BytesCodec(Codec):
+    name = "bytes"
+
+    def encode(self, value: Any) -> bytes:
+        if not isinstance(value, (bytes, bytearray, memoryview)):
+            raise TypeError(
+                f"bytes codec can't store {type(value).__name__!r}"
+            )
+        return bytes(value)
+
+    def decode(self, data: str | bytes) -> bytes:
+        return data if isinstance(data, bytes) else data.encode()
+
+
+COMPRESSORS = {"zlib": zlib, "lzma": lzma}
+
+
+class CompressedCodec(Codec):
+    """another codec plus compression of values of `threshold` bytes or more
+
+    every value starts with a byte saying whether the rest is compressed,
+    so small values don't pay for it. named e.g. "pickle+zlib"
+    """
+
+    def __init__(
+        self,
+        codec: str | Codec = "json",
+        method: str = "zlib",
+        threshold: int = 4096,
+    ):
+        if method not in COMPRESSORS:
+            raise ValueError(
+                f"unknown compression {method!r}, "
+                f"expected one of {list(COMPRESSORS)}"
+            )
+        self.codec = get_codec(codec)
+        self.method = method
+        self.threshold = threshold
+        self.name = f"{self.codec.name}+{method}"
+        self._compressor = COMPRESSORS[method]
+
+    def encode(self, value: Any) -> bytes:
+        data = self.codec.encode(value)
+        if isinstance(data, str):
+            data = data.encode()
+        if len(data) >= self.threshold:
+            return b"\x01" + self._compressor.compress(data)
+        return b"\x00" + data
+
+    def decode(self, data: str | bytes) -> Any:
+        if isinstance(data, str):
+            data = data.encode()
+        if data[0]:
+            return self.codec.decode(self._compressor.decompress(data[1:]))
+        return self.codec.decode(data[1:])
+
+
+CODECS: dict[str, type[Codec]] = {
+    codec.name: codec
+    for codec in [
+        JsonCodec,
+        OrjsonCodec,
+        MsgpackCodec,
+        PickleCodec,
+        BytesCodec,
+    ]
+}
+
+
+def get_codec(codec: str | Codec) -> Codec:
+    if isinstance(codec, Codec):
+        return codec
+    if "+" in codec:
+        inner, _, method = codec.rpartition("+")
+        return CompressedCodec(inner, method)
+    try:
+        return CODECS[codec]()
+    except KeyError:
+        raise ValueError(
+            f"unknown codec {codec!r}, expected one of {list(CODECS)}"
+        ) from None
@@ -6,15 +6,647 @@ now it's typed + we can add default values
 """
 
 import json
+import os
+import random
 import sqlite3
-from collections.abc import MutableMapping
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import (
+    Callable,
+    ItemsView,
+    Iterable,
+    Iterator,
+    Mapping,
+    MutableMapping,
+    Sequence,
+    ValuesView,
+)
 from contextlib import contextmanager
-from logging import Logger
-from typing import Any
+from itertools import islice, repeat
+from logging import Logger, getLogger
+from typing import TYPE_CHECKING, Any, NamedTuple
 from copy import deepcopy
+from urllib.parse import quote
+from weakref import WeakValueDictionary
 
+import pandas as pd
 
-class KV(MutableMapping[str, Any]):
+from .codec import Codec, CompressedCodec, get_codec
+
+if TYPE_CHECKING:
+    from .work_queue import Queue
+
+# keeps `IN (?, ?, ...)` lists under SQLITE_MAX_VARIABLE_NUMBER on old builds
+CHUNK_SIZE = 500
+# counters are bumped inside sqlite only while they stay well inside int64,
+# anything else (floats, bigints, non-numbers) goes through python
+_INT_LIMIT = 1 << 62
+# current unix time inside sqlite, compared against the expires_at column
+_NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+# bumped by every write, see KV.cas
+_VERSION_COLUMN = "version INTEGER NOT NULL DEFAULT 1"
+# per-table settings that have to survive reopening the db, e.g. the codec
+META_TABLE = "_kv_meta"
+# connection settings applied by KV(profile=...), or pass your own mapping
+PROFILES: dict[str, dict[str, Any]] = {
+    # sqlite's defaults, every commit is fsynced before it returns
+    "safe": {"synchronous": "FULL"},
+    # commits survive a process crash, the last ones may be lost on power loss
+    "fast": {"journal_mode": "WAL", "synchronous": "NORMAL"},
+    # no journal: rollbacks are undefined and a crash mid-import can corrupt
+    # the db, only use it for imports you can redo from scratch
+    "bulk-load": {
+        "journal_mode": "OFF",
+        "synchronous": "OFF",
+        "cache_size": -256_000,
+        "temp_store": "MEMORY",
+    },
+    "read-mostly": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 1 << 30,
+        "cache_size": -256_000,
+    },
+}
+_SYNCHRONOUS = {0: "OFF", 1: "NORMAL", 2: "FULL", 3: "EXTRA"}
+# values that are safe to hand out from the cache without copying
+_IMMUTABLE = (str, int, float, bool, bytes, type(None))
+# cache markers: key not in the cache / key known to be absent from the table
+_MISS = object()
+_ABSENT = object()
+
+
+def _copy(value: Any) -> Any:
+    return value if type(value) in _IMMUTABLE else deepcopy(value)
+
+
+def _prefix_end(prefix: str) -> str | None:
+    # smallest string greater than every string starting with prefix
+    while prefix:
+        last = ord(prefix[-1]) + 1
+        if last == 0xD800:
+            last = 0xE000  # surrogates can't be encoded for sqlite
+        if last <= 0x10FFFF:
+            return prefix[:-1] + chr(last)
+        prefix = prefix[:-1]
+    return None
+
+
+def _sql_literal(text: str) -> str:
+    # index expressions can't take parameters, and queries have to repeat
+    # the expression verbatim for sqlite to use the index
+    return "'" + text.replace("'", "''") + "'"
+
+
+def _frame_path(column: str) -> str:
+    # what KV._frame does in python: a dict's field, or the whole value
+    # under "value" when it isn't a dict
+    path = _sql_literal('$."' + column.replace('"', '\\"') + '"')
+    if column != "value":
+        return path
+    return f"CASE json_type(value) WHEN 'object' THEN {path} ELSE '$' END"
+
+
+def _frame_record(columns: Sequence[str], row: Any) -> dict[str, Any]:
+    # json_extract gives 1 / 0 for booleans and JSON text for nested
+    # values, and a field that isn't there has no type at all
+    record = {}
+    for i, column in enumerate(columns, 1):
+        value, kind = row[2 * i - 1], row[2 * i]
+        if kind in ("true", "false"):
+            value = kind == "true"
+        elif kind in ("object", "array"):
+            value = json.loads(value)
+        elif kind is None:
+            continue
+        record[column] = value
+    return record
+
+
+def _plain_values(frame: "pd.DataFrame") -> "pd.DataFrame":
+    # what the codecs can take: timestamps as ISO strings and None for
+    # missing values, json has no NaN
+    frame = frame.copy()
+    for name, column in frame.items():
+        if pd.api.types.is_datetime64_any_dtype(column.dtype):
+            frame[name] = column.map(
+                pd.Timestamp.isoformat, na_action="ignore"
+            )
+    return frame.astype(object).where(frame.notna(), None)
+
+
+def _chunks(it: Iterable[Any], n: int = CHUNK_SIZE):
+    it = iter(it)
+    while chunk := list(islice(it, n)):
+        yield chunk
+
+
+class ConflictError(Exception):
+    pass
+
+
+class ChangesLost(Exception):
+    pass
+
+
+class Change(NamedTuple):
+    seq: int
+    key: str
+    value: Any
+    deleted: bool
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+    nbytes: int
+
+
+class _LRUCache:
+    def __init__(self, maxsize: int = 0, maxbytes: int = 0):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        # bumped on every invalidation (which writers do after writing), so
+        # a read that raced a write doesn't cache the value from before it
+        self.generation = 0
+        self._data: OrderedDict[str, tuple[Any, int, float | None]] = (
+            OrderedDict()
+        )
+        self._mutex = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        with self._mutex:
+            try:
+                value, _, expires_at = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return _MISS
+            if expires_at is not None and expires_at <= time.time():
+                self._pop(key)
+                self.misses += 1
+                return _MISS
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(
+        self,
+        key: str,
+        value: Any,
+        nbytes: int,
+        generation: int,
+        expires_at: float | None = None,
+    ):
+        with self._mutex:
+            if generation != self.generation:
+                return
+            self._pop(key)
+            self._data[key] = (value, nbytes, expires_at)
+            self.nbytes += nbytes
+            while self._data and (
+                (self.maxsize and len(self._data) > self.maxsize)
+                or (self.maxbytes and self.nbytes > self.maxbytes)
+            ):
+                _, (_, evicted, _) = self._data.popitem(last=False)
+                self.nbytes -= evicted
+
+    def _pop(self, key: str):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+    def pop(self, key: str):
+        with self._mutex:
+            self.generation += 1
+            self._pop(key)
+
+    def clear(self):
+        with self._mutex:
+            self.generation += 1
+            self._data.clear()
+            self.nbytes = 0
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(
+            self.hits, self.misses, self.maxsize, len(self._data), self.nbytes
+        )
+
+
+def _profile_pragmas(profile: str | Mapping[str, Any]) -> dict[str, Any]:
+    if isinstance(profile, str):
+        try:
+            return PROFILES[profile]
+        except KeyError:
+            raise ValueError(
+                f"unknown profile {profile!r}, "
+                f"expected one of {list(PROFILES)}"
+            ) from None
+    return dict(profile)
+
+
+class _Connection:
+    def __init__(
+        self,
+        db: str,
+        timeout: float,
+        uri: bool,
+        pragmas: Mapping[str, Any],
+    ):
+        self.db = sqlite3.connect(db, timeout=timeout, uri=uri)
+        self.db.isolation_level = None
+        for name, value in pragmas.items():
+            self.db.execute(f"PRAGMA {name}={value}")
+        # lock() nesting depth, transactions belong to the connection
+        self.locks = 0
+        # last PRAGMA data_version seen, see KV._cached
+        self.data_version: int | None = None
+        # table -> keys written in the open transaction (None: all of them),
+        # dropped from the caches again once it commits
+        self.dirty: dict[str, set[str] | None] = {}
+
+
+class _Pool:
+    """connections to one db plus the caches of the tables opened on it
+
+    without `threadsafe` this is a single connection, otherwise every
+    thread gets its own connection on first use
+    """
+
+    def __init__(
+        self,
+        db: str,
+        timeout: float,
+        threadsafe: bool = False,
+        pragmas: Mapping[str, Any] | None = None,
+    ):
+        self.db_uri = db
+        self.timeout = timeout
+        self.threadsafe = threadsafe
+        self.uri = db.startswith("file:")
+        self.pragmas = pragmas or {}
+        self.caches: dict[str, _LRUCache] = {}
+        self._mutex = threading.Lock()
+        self._local = threading.local()
+        if not threadsafe:
+            self._conn = self._connect()
+            return
+        if db == ":memory:":
+            # private in-memory db that every thread's connection can see
+            self.db_uri = f"file:/utilki-kv-{id(self)}?vfs=memdb"
+            self.uri = True
+        elif pragmas is None:
+            # readers don't block the writer and vice versa
+            self.pragmas = {"journal_mode": "WAL"}
+        # also keeps a memdb alive after the creating thread is gone
+        self._conn = self.conn
+
+    def _connect(self) -> _Connection:
+        return _Connection(self.db_uri, self.timeout, self.uri, self.pragmas)
+
+    @property
+    def conn(self) -> _Connection:
+        if not self.threadsafe:
+            return self._conn
+        try:
+            return self._local.conn
+        except AttributeError:
+            conn = self._local.conn = self._connect()
+            return conn
+
+    def cache(self, table: str, maxsize: int, maxbytes: int) -> _LRUCache:
+        with self._mutex:
+            if table not in self.caches:
+                self.caches[table] = _LRUCache(maxsize, maxbytes)
+            return self.caches[table]
+
+    def clear_caches(self):
+        for cache in list(self.caches.values()):
+            cache.clear()
+
+    def invalidate(self, table: str, keys: Iterable[str] | None = None):
+        # keys=None drops the whole table. until a transaction commits,
+        # readers on other threads still see (and may cache) the values
+        # from before it, which this thread's data_version never catches
+        cache = self.caches.get(table)
+        if cache is None:
+            return
+        conn = self.conn
+        if keys is None:
+            cache.clear()
+            if conn.locks:
+                conn.dirty[table] = None
+            return
+        keys = list(keys)
+        for key in keys:
+            cache.pop(key)
+        if conn.locks:
+            dirty = conn.dirty.setdefault(table, set())
+            if dirty is not None:
+                dirty.update(keys)
+
+    @contextmanager
+    def transaction(self):
+        conn = self.conn
+        if not conn.locks:
+            conn.db.execute("BEGIN IMMEDIATE TRANSACTION")
+        conn.locks += 1
+        failed = False
+        try:
+            yield conn
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            conn.locks -= 1
+            if not conn.locks:
+                dirty, conn.dirty = conn.dirty, {}
+                if failed:
+                    # reads inside the transaction may have cached its writes
+                    self.clear_caches()
+                try:
+                    conn.db.execute("ROLLBACK" if failed else "COMMIT")
+                finally:
+                    for table, keys in dirty.items():
+                        self.invalidate(table, keys)
+
+
+_POOLS: WeakValueDictionary[tuple[str, str], _Pool] = WeakValueDictionary()
+_POOLS_MUTEX = threading.Lock()
+
+
+def _shared_pool(
+    db: str, timeout: float, pragmas: Mapping[str, Any] | None
+) -> _Pool:
+    if db == ":memory:":
+        return _Pool(db, timeout, True, pragmas)
+    key = (db, repr(sorted((pragmas or {}).items())))
+    with _POOLS_MUTEX:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = _POOLS[key] = _Pool(db, timeout, True, pragmas)
+        return pool
+
+
+def _open_pool(
+    db: str,
+    timeout: float,
+    threadsafe: bool,
+    profile: str | Mapping[str, Any] | None,
+) -> _Pool:
+    pragmas = _profile_pragmas(profile) if profile is not None else None
+    if threadsafe:
+        return _shared_pool(db, timeout, pragmas)
+    return _Pool(db, timeout, pragmas=pragmas)
+
+
+class _Statements:
+    create_meta = (
+        f"CREATE TABLE IF NOT EXISTS {META_TABLE} "
+        "(tbl, name, value, PRIMARY KEY (tbl, name))"
+    )
+    get_meta = f"SELECT value FROM {META_TABLE} WHERE tbl=? AND name=?"
+    set_meta = (
+        f"INSERT INTO {META_TABLE} VALUES (?, ?, ?) "
+        "ON CONFLICT(tbl, name) DO UPDATE SET value=excluded.value"
+    )
+    exists = "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?"
+
+    def __init__(self, table: str):
+        self.create = (
+            f"CREATE TABLE IF NOT EXISTS {table} "
+            f"(key PRIMARY KEY, value, expires_at, {_VERSION_COLUMN})"
+        )
+        self.columns = f"SELECT name FROM pragma_table_info('{table}')"
+        self.add_column = f"ALTER TABLE {table} ADD COLUMN {{}}"
+        self.create_expires_index = (
+            f"CREATE INDEX IF NOT EXISTS {table}_expires_at "
+            f"ON {table} (expires_at) WHERE expires_at IS NOT NULL"
+        )
+        live = f"({table}.expires_at IS NULL OR {table}.expires_at > {_NOW})"
+        self.count = f"SELECT COUNT(*) FROM {table} WHERE {live}"
+        self.count_all = f"SELECT COUNT(*) FROM {table}"
+        # the triggers' row count still has expired rows nobody purged,
+        # the expires_at index finds those without reading the table
+        self.counted_len = (
+            f"SELECT (SELECT value FROM {META_TABLE} "
+            f"WHERE tbl='{table}' AND name='rows') - "
+            f"(SELECT COUNT(*) FROM {table} WHERE expires_at <= {_NOW})"
+        )
+        self.keys = f"SELECT key FROM {table} WHERE {live}"
+        self.page = (
+            f"SELECT key, value FROM {table} "
+            f"WHERE key > ? AND {live} ORDER BY key LIMIT ?"
+        )
+        self.first_page = (
+            f"SELECT key, value FROM {table} WHERE {live} "
+            "ORDER BY key LIMIT ?"
+        )
+        # row count and value bytes kept in the meta table by triggers
+        nbytes = "coalesce(length(CAST({}.value AS BLOB)), 0)"
+        bump = (
+            f"UPDATE {META_TABLE} SET value = value + {{}} "
+            f"WHERE tbl = '{table}' AND name = '{{}}';"
+        )
+        self.counters = [
+            f"CREATE TRIGGER IF NOT EXISTS {table}_kv_insert "
+            f"AFTER INSERT ON {table} BEGIN "
+            + bump.format(1, "rows")
+            + bump.format(nbytes.format("NEW"), "value_bytes")
+            + " END",
+            f"CREATE TRIGGER IF NOT EXISTS {table}_kv_delete "
+            f"AFTER DELETE ON {table} BEGIN "
+            + bump.format(-1, "rows")
+            + bump.format("-" + nbytes.format("OLD"), "value_bytes")
+            + " END",
+            f"CREATE TRIGGER IF NOT EXISTS {table}_kv_update "
+            f"AFTER UPDATE OF value ON {table} BEGIN "
+            + bump.format(
+                f"{nbytes.format('NEW')} - {nbytes.format('OLD')}",
+                "value_bytes",
+            )
+            + " END",
+        ]
+        self.value_bytes = f"SELECT SUM({nbytes.format(table)}) FROM {table}"
+        self.get = (
+            f"SELECT value, expires_at FROM {table} WHERE key=? AND {live}"
+        )
+        self.set = (
+            f"INSERT INTO {table} (key, value, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value=excluded.value, "
+            "expires_at=excluded.expires_at, version=version + 1"
+        )
+        self.get_versioned = (
+            f"SELECT value, version FROM {table} WHERE key=? AND {live}"
+        )
+        self.cas = (
+            f"UPDATE {table} SET value=?, expires_at=?, version=version + 1 "
+            f"WHERE key=? AND version=? AND {live} RETURNING version"
+        )
+        self.cas_insert = (
+            f"INSERT INTO {table} (key, value, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value=excluded.value, "
+            "expires_at=excluded.expires_at, version=version + 1 "
+            f"WHERE NOT {live} RETURNING version"
+        )
+        self.rowid = f"SELECT rowid FROM {table} WHERE key=? AND {live}"
+        self.set_blob = (
+            f"INSERT INTO {table} (key, value, expires_at) "
+            "VALUES (?, zeroblob(?), ?) "
+            "ON CONFLICT(key) DO UPDATE SET value=excluded.value, "
+            "expires_at=excluded.expires_at, version=version + 1 "
+            "RETURNING rowid"
+        )
+        self.delete = f"DELETE FROM {table} WHERE key=? RETURNING {live}"
+        self.get_in = (
+            f"SELECT key, value, expires_at FROM {table} "
+            f"WHERE key IN ({{}}) AND {live}"
+        )
+        self.delete_in = (
+            f"DELETE FROM {table} WHERE key IN ({{}}) RETURNING {live}"
+        )
+        # expired rows are rewritten by the python fallback in KV.incr
+        is_counter = (
+            f"json_type({table}.value) = 'integer' "
+            f"AND abs({table}.value) < {_INT_LIMIT} AND {live}"
+        )
+        self.incr = (
+            f"UPDATE {table} "
+            "SET value=CAST(value + ? AS TEXT), version=version + 1 "
+            f"WHERE key=? AND {is_counter} RETURNING value"
+        )
+        self.incr_seeded = (
+            f"INSERT INTO {table} (key, value, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE "
+            "SET value=CAST(value + ? AS TEXT), version=version + 1 "
+            f"WHERE {is_counter} RETURNING value"
+        )
+        self.scan = (
+            f"SELECT key, value FROM {table} WHERE {live}{{}} "
+            "ORDER BY key {} LIMIT ?"
+        )
+        self.delete_range = f"DELETE FROM {table} WHERE key >= ?{{}}"
+        self.frame = (
+            f"SELECT key, {{}} FROM {table} WHERE {live}{{}} "
+            "ORDER BY key LIMIT ?"
+        )
+        # indexes over a JSON path in the value, see KV.create_index
+        self.create_index = (
+            f"CREATE INDEX IF NOT EXISTS {table}_{{}} "
+            f"ON {table} (json_extract(value, {{}}), key)"
+        )
+        self.drop_index = f"DROP INDEX IF EXISTS {table}_{{}}"
+        self.where = (
+            f"SELECT key, value FROM {table} WHERE {live}{{}} "
+            "ORDER BY key LIMIT ?"
+        )
+        # opt-in change feed: one row per key at its latest write, so the
+        # log never holds more rows than there are keys, see KV.changes
+        changes = f"{table}_changes"
+        self.changelog = [
+            (
+                f"CREATE TABLE IF NOT EXISTS {changes} "
+                "(seq INTEGER PRIMARY KEY AUTOINCREMENT, key)"
+            ),
+            f"CREATE INDEX IF NOT EXISTS {changes}_key ON {changes} (key)",
+        ] + [
+            f"CREATE TRIGGER IF NOT EXISTS {table}_changes_{event} "
+            f"AFTER {event} ON {table} BEGIN "
+            f"DELETE FROM {changes} WHERE key = {row}.key; "
+            f"INSERT INTO {changes} (key) VALUES ({row}.key); END"
+            for event, row in [
+                ("insert", "NEW"),
+                ("update", "NEW"),
+                ("delete", "OLD"),
+            ]
+        ]
+        self.changes = (
+            f"SELECT c.seq, c.key, {table}.value, {table}.key IS NULL "
+            f"FROM {changes} c LEFT JOIN {table} "
+            f"ON {table}.key = c.key AND {live} "
+            "WHERE c.seq > ?{} ORDER BY c.seq LIMIT ?"
+        )
+        self.change_seq = f"SELECT coalesce(max(seq), 0) FROM {changes}"
+        self.changes_cutoff = (
+            f"SELECT seq FROM {changes} ORDER BY seq DESC LIMIT 1 OFFSET ?"
+        )
+        self.trim_changes = f"DELETE FROM {changes} WHERE seq <= ?"
+        self.purge = (
+            f"DELETE FROM {table} WHERE key IN (SELECT key FROM {table} "
+            f"WHERE expires_at <= {_NOW} LIMIT ?)"
+        )
+
+
+class _ItemsView(ItemsView[str, Any]):
+    _mapping: "KV"
+
+    def __iter__(self):
+        for batch in self._mapping.iter_batches():
+            yield from batch
+
+
+class _ValuesView(ValuesView[Any]):
+    _mapping: "KV"
+
+    def __iter__(self):
+        for batch in self._mapping.iter_batches():
+            for _, value in batch:
+                yield value
+
+
+class _KVMethods:
+    """shared by KV and the classes wrapping it, which bring their own
+    incr(), set_many(), lock() and a threading.local `_local`
+
+    `kv.hits += 1` increments the key "hits": reading the attribute
+    remembers its name (per thread), += increments that key, and assigning
+    kv back to the attribute afterwards is dropped
+    """
+
+    _local: threading.local
+    incr: Callable[..., Any]
+    set_many: Callable[..., Any]
+    lock: Callable[..., Any]
+
+    @property
+    def _attr(self) -> str | None:
+        return getattr(self._local, "attr", None)
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        self._local.attr = name
+        return self
+
+    def __iadd__(self, other: int):
+        if self._attr is None:
+            raise AttributeError(
+                f"'{type(self).__name__}' object has no attribute '_attr'"
+            )
+        self.incr(self._attr, other)
+        return self
+
+    def __setattr__(self, name: str, value: Any):
+        # `kv.x += 1` ends with `kv.x = kv`, the increment already happened
+        if value is self and not name.startswith("_"):
+            return
+        super().__setattr__(name, value)
+
+    def update(self, other: Any = (), /, **kwargs: Any):
+        if not isinstance(other, Mapping) and hasattr(other, "keys"):
+            other = ((key, other[key]) for key in other.keys())
+        with self.lock():
+            self.set_many(other)
+            if kwargs:
+                self.set_many(kwargs)
+
+
+class KV(_KVMethods, MutableMapping[str, Any]):
     def __init__(
         self,
         db: str = ":memory:",
@@ -22,23 +654,417 @@ class KV(MutableMapping[str, Any]):
         default: Any = None,
         timeout: int = 5,
         logger: Logger | None = None,
+        codec: str | Codec | None = None,
+        cache_size: int = 0,
+        cache_bytes: int = 0,
+        threadsafe: bool = False,
+        profile: str | Mapping[str, Any] | None = None,
+        batch_size: int = 1000,
+        counted: bool = False,
+        default_ttl: float | None = None,
+        purge_every: int = 1000,
+        compress: str | None = None,
+        changelog: int | None = None,
+        readonly: bool = False,
+        pool: _Pool | None = None,
     ):
+        self.batch_size = batch_size
+        # lock() overrides and the `kv.x += 1` target are per thread
+        self._local = threading.local()
         self._db_uri = db
         self._table = table
-        self._default = default
+        self._base_default = default
         self._logger = logger
-        self._db = sqlite3.connect(db, timeout=timeout)
-        self._db.isolation_level = None
-        self._attr: str = None  # type: ignore
-        self._locks = 0
-        self._execute(
-            f"""
-            CREATE TABLE IF NOT EXISTS {self._table} 
-            (key PRIMARY KEY, value)
-            """
+        self._timeout = timeout
+        self._profile = profile
+        self._default_ttl = default_ttl
+        self._purge_every = purge_every
+        self._writes = 0
+        self._readonly = readonly
+        # KVStore and clone() hand in the pool of the store / original
+        self._pool = pool or _open_pool(db, timeout, threadsafe, profile)
+        self._sql = _Statements(table)
+        existed = bool(self._execute(self._sql.exists, (table,)).fetchall())
+        if readonly:
+            if not existed:
+                raise ValueError(f"no table {table!r} in {db!r}")
+        else:
+            self._execute(self._sql.create)
+            self._migrate()
+            self._execute(self._sql.create_meta)
+        if compress is not None:
+            codec = CompressedCodec(codec or "json", compress)
+        self._codec = self._resolve_codec(codec, existed)
+        self._encode = self._codec.encode
+        self._decode = self._codec.decode
+        self._cache: _LRUCache | None = None
+        if cache_size or cache_bytes:
+            self._cache = self._pool.cache(table, cache_size, cache_bytes)
+        # rate limiters by their arguments, see KV.rate_limit
+        self._limiters: dict[tuple[Any, ...], Any] = {}
+        self._indexes: dict[str, str] = json.loads(
+            self._get_meta("indexes") or "{}"
         )
+        self._counted = self._get_meta("rows") is not None
+        if counted and not self._counted:
+            self._start_counting()
+        self._changelog: int | None = self._get_meta("changelog")
+        if changelog is not None and changelog != self._changelog:
+            self._start_changelog(changelog)
+
+    @classmethod
+    def open_readonly(
+        cls,
+        path: str,
+        table: str = "kv",
+        immutable: bool = False,
+        mmap_size: int = 1 << 30,
+        **kwargs: Any,
+    ) -> "KV":
+        # many readers map the same file and share the os page cache.
+        # immutable=1 also skips locking and change detection, only use it
+        # for files nobody writes to anymore, e.g. a snapshot(). a db last
+        # written by an older version has to be opened for writing once to
+        # migrate it
+        uri = f"file:{quote(os.path.abspath(path))}?mode=ro"
+        if immutable:
+            uri += "&immutable=1"
+        kwargs.setdefault("profile", {"mmap_size": mmap_size})
+        return cls(uri, table, readonly=True, **kwargs)
+
+    def _migrate(self):
+        # tables created by older versions only have (key, value)
+        columns = {name for [name] in self._execute(self._sql.columns)}
+        if "expires_at" not in columns:
+            self._execute(self._sql.add_column.format("expires_at"))
+        if "version" not in columns:
+            self._execute(self._sql.add_column.format(_VERSION_COLUMN))
+        self._execute(self._sql.create_expires_index)
+
+    def _start_counting(self):
+        with self.lock():
+            for sql in self._sql.counters:
+                self._execute(sql)
+            [[rows]] = self._execute(self._sql.count_all)
+            [[nbytes]] = self._execute(self._sql.value_bytes)
+            self._set_meta("rows", rows)
+            self._set_meta("value_bytes", nbytes or 0)
+        self._counted = True
+
+    def _start_changelog(self, size: int):
+        if size < 1:
+            raise ValueError(
+                f"changelog must keep at least 1 entry, not {size}"
+            )
+        with self.lock():
+            for sql in self._sql.changelog:
+                self._execute(sql)
+            self._set_meta("changelog", size)
+        self._changelog = size
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        return self._pool.conn.db
+
+    @property
+    def _default(self) -> Any:
+        return getattr(self._local, "default", self._base_default)
+
+    def _get_meta(self, name: str) -> Any:
+        for [value] in self._execute(self._sql.get_meta, (self._table, name)):
+            return value
+        return None
+
+    def _set_meta(self, name: str, value: Any):
+        self._execute(self._sql.set_meta, (self._table, name, value))
+
+    def _resolve_codec(self, codec: str | Codec | None, existed: bool):
+        stored = None
+        if existed:
+            # tables created before codecs were recorded hold json
+            stored = self._get_meta("codec") or "json"
+        if codec is None:
+            resolved = get_codec(stored or "json")
+        else:
+            resolved = get_codec(codec)
+            if stored is not None and stored != resolved.name:
+                raise ValueError(
+                    f"table {self._table!r} was written with codec "
+                    f"{stored!r}, not {resolved.name!r}"
+                )
+        if not self._readonly and self._get_meta("codec") != resolved.name:
+            self._set_meta("codec", resolved.name)
+        return resolved
+
+    def profile(self) -> dict[str, Any]:
+        name = self._profile
+        info: dict[str, Any] = {
+            "profile": name
+            if name is None or isinstance(name, str)
+            else "custom"
+        }
+        pragmas = ["journal_mode", "synchronous", "cache_size", "mmap_size"]
+        pragmas += [
+            name for name in self._pool.pragmas if name not in pragmas
+        ]
+        for pragma in pragmas:
+            [[value]] = self._execute(f"PRAGMA {pragma}")
+            if pragma == "synchronous":
+                value = _SYNCHRONOUS.get(value, value)
+            info[pragma] = value
+        return info
+
+    def _get_data_version(self) -> int:
+        [[version]] = self._execute("PRAGMA data_version")
+        return version
+
+    def _synced_cache(self) -> _LRUCache | None:
+        # data_version moves whenever another connection commits
+        cache = self._cache
+        if cache is None:
+            return None
+        conn = self._pool.conn
+        version = self._get_data_version()
+        if version != conn.data_version:
+            self._pool.clear_caches()
+            conn.data_version = version
+        return cache
+
+    def _cached(self, key: str) -> Any:
+        cache = self._synced_cache()
+        return _MISS if cache is None else cache.get(key)
+
+    def _invalidate(self, keys: Iterable[str]):
+        # a KV without a cache can still share the connection with one
+        # that has it, e.g. clone() or another threadsafe KV on the db
+        self._pool.invalidate(self._table, keys)
+
+    def cache_info(self) -> CacheInfo:
+        if self._cache is None:
+            return CacheInfo(0, 0, 0, 0, 0)
+        return self._cache.info()
+
+    def cache_clear(self):
+        self._pool.invalidate(self._table)
+
+    def _expires_at(self, ttl: float | None = None) -> float | None:
+        ttl = self._default_ttl if ttl is None else ttl
+        return None if ttl is None else time.time() + ttl
+
+    def _wrote(self, n: int = 1):
+        if self._purge_every:
+            self._writes += n
+            if self._writes >= self._purge_every:
+                self._writes = 0
+                self.purge_expired(self._purge_every)
+                if self._changelog:
+                    self.trim_changes()
+
+    def snapshot(
+        self,
+        path: str,
+        pages: int = 1000,
+        sleep: float = 0.005,
+        progress: Callable[[int, int, int], object] | None = None,
+    ):
+        # online copy with the backup api, `pages` at a time with a pause
+        # in between so writers aren't starved. writes through this KV are
+        # carried over, writes from other connections restart the copy
+        target = sqlite3.connect(path)
+        try:
+            self._db.backup(
+                target, pages=pages, progress=progress, sleep=sleep
+            )
+        finally:
+            target.close()
+
+    def compact(self, pages: int = 1000) -> int:
+        # the first call switches the db to incremental auto_vacuum, which
+        # takes one full VACUUM. after that free pages are handed back to
+        # the os `pages` at a time so writers get the lock in between
+        [[before]] = self._execute("PRAGMA page_count")
+        [[mode]] = self._execute("PRAGMA auto_vacuum")
+        if mode != 2:
+            self._execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self._execute("VACUUM")
+        else:
+            vacuum = f"PRAGMA incremental_vacuum({int(pages)})"
+            while True:
+                [[free]] = self._execute("PRAGMA freelist_count")
+                if not free:
+                    break
+                self._execute(vacuum).fetchall()
+        [[after]] = self._execute("PRAGMA page_count")
+        return before - after
+
+    def purge_expired(self, limit: int = 1000) -> int:
+        deleted = self._execute(self._sql.purge, (limit,)).rowcount
+        if deleted:
+            self._pool.clear_caches()
+        return deleted
+
+    def purge_in_background(
+        self, interval: float = 60.0, limit: int = 1000
+    ) -> threading.Event:
+        """purge expired rows from a daemon thread until the event is set"""
+        open_kv = self._other_thread()
+        stop = threading.Event()
+
+        def purge():
+            purger = open_kv()
+            while not stop.wait(interval):
+                # small batches so writers never wait long on the lock
+                while purger.purge_expired(limit) == limit:
+                    if stop.is_set():
+                        return
+
+        threading.Thread(target=purge, daemon=True).start()
+        return stop
+
+    def _other_thread(self) -> Callable[[], "KV"]:
+        # call it on the other thread, connections belong to their thread
+        if self._pool.threadsafe:
+            return lambda: self
+        if self._db_uri == ":memory:":
+            raise ValueError(
+                "a private :memory: db can't be used from another thread, "
+                "use threadsafe=True"
+            )
+        return lambda: KV(self._db_uri, self._table, codec=self._codec)
+
+    def change_seq(self) -> int:
+        """sequence number of the latest change, to pass to changes()"""
+        self._check_changelog()
+        [[seq]] = self._execute(self._sql.change_seq)
+        return seq
+
+    def _check_changelog(self):
+        if not self._changelog:
+            raise ValueError(
+                f"table {self._table!r} has no changelog, "
+                "open it with KV(changelog=<entries to keep>)"
+            )
+
+    def changes(
+        self,
+        since: int = 0,
+        prefix: str | None = None,
+        n: int | None = None,
+    ) -> Iterator[list[Change]]:
+        # keys changed after `since`, each once with its current value.
+        # expired keys show up as deleted once they are purged
+        self._check_changelog()
+        trimmed = self._get_meta("changes_trimmed") or 0
+        if since < trimmed:
+            raise ChangesLost(
+                f"changes up to {trimmed} were trimmed, can't resume from "
+                f"{since}, reread the table and continue from change_seq()"
+            )
+        n = n or self.batch_size
+        where, params = "", ()
+        if prefix is not None:
+            where, params = " AND c.key >= ?", (prefix,)
+            upper = _prefix_end(prefix)
+            if upper is not None:
+                where, params = where + " AND c.key < ?", (prefix, upper)
+        return self._iter_changes(
+            self._sql.changes.format(where), since, params, n
+        )
+
+    def _iter_changes(
+        self, sql: str, since: int, params: tuple[str, ...], n: int
+    ) -> Iterator[list[Change]]:
+        while rows := self._execute(sql, (since, *params, n)).fetchall():
+            yield [
+                Change(
+                    seq,
+                    key,
+                    None if deleted else self._decode(value),
+                    bool(deleted),
+                )
+                for seq, key, value, deleted in rows
+            ]
+            if len(rows) < n:
+                return
+            since = rows[-1][0]
+
+    def trim_changes(self) -> int:
+        """drop changelog entries beyond the retention size, oldest first"""
+        if not self._changelog:
+            return 0
+        with self.lock():
+            for [cutoff] in self._execute(
+                self._sql.changes_cutoff, (self._changelog,)
+            ):
+                self._set_meta("changes_trimmed", cutoff)
+                return self._execute(
+                    self._sql.trim_changes, (cutoff,)
+                ).rowcount
+        return 0
+
+    def watch(
+        self,
+        prefix: str | None,
+        callback: Callable[[Change], Any],
+        interval: float = 1.0,
+        since: int | None = None,
+    ) -> threading.Event:
+        """call back with every change under prefix from a daemon thread,
+        polling only the changelog tail, until the event is set
+
+        errors are logged and the thread keeps going. a failed callback
+        doesn't get the change again, and a watcher that fell behind the
+        changelog skips ahead to its latest change
+        """
+        open_kv = self._other_thread()
+        start = self.change_seq() if since is None else since
+        stop = threading.Event()
+        log = self._logger or getLogger(__name__)
+
+        def poll():
+            watcher, seq = open_kv(), start
+            while not stop.wait(interval):
+                try:
+                    for batch in watcher.changes(seq, prefix):
+                        for change in batch:
+                            try:
+                                callback(change)
+                            except Exception:
+                                log.exception("watch callback failed")
+                        seq = batch[-1].seq
+                except ChangesLost:
+                    log.exception("watch lost changes, skipping ahead")
+                    seq = watcher.change_seq()
+                except Exception:
+                    log.exception("watch failed to poll, retrying")
+
+        threading.Thread(target=poll, daemon=True).start()
+        return stop
 
     def incr(self, key: str, amount: int = 1) -> int:
+        if (
+            self._codec.json
+            and type(amount) is int
+            and abs(amount) < _INT_LIMIT
+        ):
+            default = self._default
+            if type(default) is int and abs(default) < _INT_LIMIT:
+                rows = self._execute(
+                    self._sql.incr_seeded,
+                    (
+                        key,
+                        self._encode(default + amount),
+                        self._expires_at(),
+                        amount,
+                    ),
+                ).fetchall()
+            else:
+                rows = self._execute(self._sql.incr, (amount, key)).fetchall()
+            self._invalidate((key,))
+            if rows:
+                self._wrote()
+                return self._decode(rows[0][0])
+        # missing key without a numeric default, or a non-integer value
         with self.lock():
             val = self[key]
             val += amount
@@ -46,99 +1072,586 @@ class KV(MutableMapping[str, Any]):
             return val
 
     def decr(self, key: str, amount: int = 1) -> int:
+        return self.incr(key, -amount)
+
+    def incr_many(self, amounts: Mapping[str, int]) -> dict[str, int]:
         with self.lock():
-            val = self[key]
-            val -= amount
-            self[key] = val
-            return val
+            return {key: self.incr(key, n) for key, n in amounts.items()}
+
+    def set_many(
+        self,
+        items: Mapping[str, Any] | Iterable[tuple[str, Any]],
+        ttl: float | None = None,
+    ):
+        if isinstance(items, Mapping):
+            items = items.items()
+        items = list(items)
+        expires_at = self._expires_at(ttl)
+        rows = (
+            (key, self._encode(value), expires_at) for key, value in items
+        )
+        with self.lock():
+            self._db.cursor().executemany(self._sql.set, rows)
+        self._invalidate(key for key, _ in items)
+        self._wrote(len(items))
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        keys = list(keys)
+        found: dict[str, Any] = {}
+        missing = []
+        # one data_version check for the whole batch
+        cache = self._synced_cache()
+        if cache is None:
+            missing = keys
+        else:
+            for key in keys:
+                value = cache.get(key)
+                if value is _MISS:
+                    missing.append(key)
+                elif value is not _ABSENT:
+                    found[key] = _copy(value)
+        generation = cache.generation if cache is not None else 0
+        for chunk in _chunks(missing):
+            marks = ", ".join("?" * len(chunk))
+            for key, data, expires_at in self._execute(
+                self._sql.get_in.format(marks), tuple(chunk)
+            ):
+                found[key] = value = self._decode(data)
+                if cache is not None:
+                    cache.put(
+                        key, _copy(value), len(data), generation, expires_at
+                    )
+        if self._default is None:
+            return {key: found[key] for key in keys if key in found}
+        return {
+            key: found[key] if key in found else deepcopy(self._default)
+            for key in keys
+        }
+
+    def delete_many(self, keys: Iterable[str]) -> int:
+        keys = list(keys)
+        deleted = 0
+        with self.lock():
+            for chunk in _chunks(keys):
+                marks = ", ".join("?" * len(chunk))
+                deleted += sum(
+                    live
+                    for [live] in self._execute(
+                        self._sql.delete_in.format(marks), tuple(chunk)
+                    )
+                )
+        self._invalidate(keys)
+        return deleted
 
     def clone(self, table: str) -> "KV":
-        return KV(self._db_uri, table)
+        # another table on the same connections, so it's cheap and can be
+        # written in the same lock()
+        return KV(
+            self._db_uri,
+            table,
+            default=self._base_default,
+            timeout=self._timeout,
+            logger=self._logger,
+            codec=self._codec,
+            profile=self._profile,
+            batch_size=self.batch_size,
+            default_ttl=self._default_ttl,
+            purge_every=self._purge_every,
+            readonly=self._readonly,
+            pool=self._pool,
+        )
 
-    def _execute(self, sql: str, params: tuple[str, ...] = ()):
+    def _execute(
+        self, sql: str, params: Sequence[Any] | Mapping[str, Any] = ()
+    ):
         if params:
             return self._db.cursor().execute(sql, params)
         else:
             return self._db.cursor().execute(sql)
 
     def __len__(self):
-        [[n]] = self._execute(f"SELECT COUNT(*) FROM {self._table}")
+        sql = self._sql.counted_len if self._counted else self._sql.count
+        [[n]] = self._execute(sql)
         return n
 
+    def stats(self) -> dict[str, Any]:
+        stats: dict[str, Any] = {
+            "rows": self._get_meta("rows"),
+            "value_bytes": self._get_meta("value_bytes"),
+        }
+        for pragma in ["page_count", "page_size", "freelist_count"]:
+            [[stats[pragma]]] = self._execute(f"PRAGMA {pragma}")
+        return stats
+
     def __getitem__(self, key: str) -> int:
         if key is None:  # type: ignore
             raise ValueError("key cannot be None")
 
-        for row in self._execute(
-            f"""
-            SELECT value FROM {self._table} WHERE key=?
-            """,
-            (key,),
-        ):
-            result = json.loads(row[0])
-            return result
+        cached = self._cached(key)
+        generation = self._cache.generation if self._cache else 0
+        if cached is not _MISS and cached is not _ABSENT:
+            return _copy(cached)
+        if cached is _MISS:
+            for row in self._execute(self._sql.get, (key,)):
+                result = self._decode(row[0])
+                if self._cache is not None:
+                    self._cache.put(
+                        key, _copy(result), len(row[0]), generation, row[1]
+                    )
+                return result
+            if self._cache is not None:
+                self._cache.put(key, _ABSENT, 0, generation)
+        if self._default is not None:
+            return deepcopy(self._default)
         else:
-            if self._default is not None:
-                return deepcopy(self._default)
-            else:
-                raise KeyError
+            raise KeyError
 
     def __iter__(self):
-        return (
-            key for [key] in self._execute(f"SELECT key FROM {self._table}")
+        return (key for [key] in self._execute(self._sql.keys))
+
+    def iter_batches(
+        self, n: int | None = None
+    ) -> Iterator[list[tuple[str, Any]]]:
+        # keyset pagination: every page is its own short read, so walking a
+        # huge table neither holds a read transaction open nor loads it all
+        n = n or self.batch_size
+        rows = self._execute(self._sql.first_page, (n,)).fetchall()
+        while rows:
+            yield [(key, self._decode(value)) for key, value in rows]
+            if len(rows) < n:
+                return
+            rows = self._execute(self._sql.page, (rows[-1][0], n)).fetchall()
+
+    def scan(
+        self,
+        prefix: str | None = None,
+        start: str | None = None,
+        end: str | None = None,
+        limit: int | None = None,
+        reverse: bool = False,
+    ) -> Iterator[tuple[str, Any]]:
+        # keys in [start, end) that start with prefix, read in pages off the
+        # primary key index
+        lower, upper = start, end
+        if prefix is not None:
+            lower = prefix if lower is None else max(lower, prefix)
+            prefix_end = _prefix_end(prefix)
+            if upper is None or (
+                prefix_end is not None and prefix_end < upper
+            ):
+                upper = prefix_end
+        lower_op = ">="
+        while limit is None or limit > 0:
+            clauses, params = "", []
+            if lower is not None:
+                clauses += f" AND key {lower_op} ?"
+                params.append(lower)
+            if upper is not None:
+                clauses += " AND key < ?"
+                params.append(upper)
+            n = (
+                self.batch_size
+                if limit is None
+                else min(limit, self.batch_size)
+            )
+            rows = self._execute(
+                self._sql.scan.format(clauses, "DESC" if reverse else "ASC"),
+                (*params, n),
+            ).fetchall()
+            for key, value in rows:
+                yield key, self._decode(value)
+            if len(rows) < n:
+                return
+            if limit is not None:
+                limit -= len(rows)
+            if reverse:
+                upper = rows[-1][0]
+            else:
+                lower, lower_op = rows[-1][0], ">"
+
+    def to_frame(
+        self,
+        prefix: str | None = None,
+        columns: Sequence[str] | None = None,
+        chunksize: int | None = None,
+    ) -> "pd.DataFrame | Iterator[pd.DataFrame]":
+        # dict values become columns, anything else lands in a "value"
+        # column. with a JSON codec `columns` are pulled out by sqlite
+        # without decoding the rest of the value, the frame comes out the
+        # same as decoding it all
+        frames = self._iter_frames(prefix, columns, chunksize or 100_000)
+        if chunksize:
+            return frames
+        return pd.concat(list(frames) or [self._frame([], [], columns)])
+
+    def _iter_frames(
+        self,
+        prefix: str | None,
+        columns: Sequence[str] | None,
+        n: int,
+    ) -> Iterator["pd.DataFrame"]:
+        in_sql = columns is not None and self._codec.json
+        names = list(columns or [])
+        select = "value"
+        if in_sql:
+            select = ", ".join(
+                f"json_extract(value, {path}), json_type(value, {path})"
+                for path in map(_frame_path, names)
+            )
+        lower = prefix
+        upper = None if prefix is None else _prefix_end(prefix)
+        lower_op = ">="
+        while True:
+            clauses, params = "", []
+            if lower is not None:
+                clauses += f" AND key {lower_op} ?"
+                params.append(lower)
+            if upper is not None:
+                clauses += " AND key < ?"
+                params.append(upper)
+            rows = self._execute(
+                self._sql.frame.format(select, clauses), (*params, n)
+            ).fetchall()
+            if not rows:
+                return
+            if in_sql:
+                yield pd.DataFrame(
+                    [_frame_record(names, row) for row in rows],
+                    index=pd.Index([row[0] for row in rows], name="key"),
+                    columns=columns,
+                )
+            else:
+                yield self._frame(
+                    [key for key, _ in rows],
+                    [self._decode(value) for _, value in rows],
+                    columns,
+                )
+            if len(rows) < n:
+                return
+            lower, lower_op = rows[-1][0], ">"
+
+    @staticmethod
+    def _frame(
+        keys: list[str], values: list[Any], columns: Sequence[str] | None
+    ) -> "pd.DataFrame":
+        records = [
+            value if isinstance(value, dict) else {"value": value}
+            for value in values
+        ]
+        return pd.DataFrame(
+            records,
+            index=pd.Index(keys, name="key"),
+            columns=columns,
         )
 
-    def __setitem__(self, key: str, value: Any):
-        jvalue = json.dumps(value)
+    def from_frame(
+        self,
+        df: "pd.DataFrame",
+        key_col: str | None = None,
+        value_cols: str | Sequence[str] | None = None,
+        ttl: float | None = None,
+        chunksize: int = 10_000,
+    ) -> int:
+        # keys come from key_col or the index, as strings. a single value
+        # column is stored as is, several become one dict per row. every
+        # chunk is its own transaction, wrap the call in lock() to make it
+        # all-or-nothing
+        if value_cols is None:
+            value_cols = [
+                column for column in df.columns if column != key_col
+            ]
+        expires_at = self._expires_at(ttl)
+        for start in range(0, len(df), chunksize):
+            chunk = df.iloc[start : start + chunksize]
+            keys = map(
+                str, chunk.index if key_col is None else chunk[key_col]
+            )
+            if isinstance(value_cols, str):
+                frame = _plain_values(chunk[[value_cols]])
+                values = map(self._encode, frame[value_cols].tolist())
+            else:
+                frame = _plain_values(chunk[list(value_cols)])
+                values = map(self._encode, frame.to_dict("records"))
+            with self.lock():
+                self._db.cursor().executemany(
+                    self._sql.set, zip(keys, values, repeat(expires_at))
+                )
+        self._pool.clear_caches()
+        self._wrote(len(df))
+        return len(df)
+
+    def create_index(self, name: str, path: str | None = None):
+        if not self._codec.json:
+            raise ValueError(
+                f"can't index values stored with codec {self._codec.name!r}"
+            )
+        if not name.isidentifier():
+            raise ValueError(
+                f"index name must be an identifier, not {name!r}"
+            )
+        path = path or f"$.{name}"
         with self.lock():
-            try:
-                self._execute(
-                    f"INSERT INTO {self._table} VALUES (?, ?)",
-                    (key, jvalue),
+            self._execute(
+                self._sql.create_index.format(name, _sql_literal(path))
+            )
+            indexes = json.loads(self._get_meta("indexes") or "{}")
+            indexes[name] = path
+            self._set_meta("indexes", json.dumps(indexes))
+        self._indexes = indexes
+
+    def drop_index(self, name: str):
+        if name not in self._indexes:
+            self._indexes = json.loads(self._get_meta("indexes") or "{}")
+        if name not in self._indexes:
+            raise KeyError(f"no index named {name!r}")
+        with self.lock():
+            self._execute(self._sql.drop_index.format(name))
+            indexes = json.loads(self._get_meta("indexes") or "{}")
+            indexes.pop(name, None)
+            self._set_meta("indexes", json.dumps(indexes))
+        self._indexes = indexes
+
+    def where(self, **fields: Any) -> Iterator[tuple[str, Any]]:
+        return self._where(fields)
+
+    def _where(
+        self, fields: Mapping[str, Any], after: str | None = None
+    ) -> Iterator[tuple[str, Any]]:
+        # equality on indexed fields, the first one picks the index and every
+        # page continues from the last key seen
+        if not fields:
+            raise ValueError("where() needs at least one field")
+        clauses, params = "", []
+        for name, value in fields.items():
+            if name not in self._indexes:
+                self._indexes = json.loads(self._get_meta("indexes") or "{}")
+            if name not in self._indexes:
+                raise KeyError(f"no index named {name!r}, see create_index()")
+            path = _sql_literal(self._indexes[name])
+            clauses += f" AND json_extract(value, {path}) IS ?"
+            params.append(value)
+        # "" is a key too, the first page starts at it rather than after
+        last, op = ("", ">=") if after is None else (after, ">")
+        while True:
+            rows = self._execute(
+                self._sql.where.format(f"{clauses} AND key {op} ?"),
+                (*params, last, self.batch_size),
+            ).fetchall()
+            for key, value in rows:
+                yield key, self._decode(value)
+            if len(rows) < self.batch_size:
+                return
+            last, op = rows[-1][0], ">"
+
+    def delete_prefix(self, prefix: str) -> int:
+        upper = _prefix_end(prefix)
+        if upper is None:
+            deleted = self._execute(
+                self._sql.delete_range.format(""), (prefix,)
+            ).rowcount
+        else:
+            deleted = self._execute(
+                self._sql.delete_range.format(" AND key < ?"), (prefix, upper)
+            ).rowcount
+        self.cache_clear()
+        return deleted
+
+    def items(self) -> "_ItemsView":
+        return _ItemsView(self)
+
+    def values(self) -> "_ValuesView":
+        return _ValuesView(self)
+
+    def get_versioned(self, key: str) -> tuple[Any, int]:
+        # version 0 stands for "not there", cas() with it inserts
+        for value, version in self._execute(self._sql.get_versioned, (key,)):
+            return self._decode(value), version
+        if self._default is not None:
+            return deepcopy(self._default), 0
+        raise KeyError(key)
+
+    def cas(
+        self,
+        key: str,
+        expected_version: int,
+        value: Any,
+        ttl: float | None = None,
+    ) -> bool:
+        data, expires_at = self._encode(value), self._expires_at(ttl)
+        if expected_version:
+            rows = self._execute(
+                self._sql.cas, (data, expires_at, key, expected_version)
+            ).fetchall()
+        else:
+            rows = self._execute(
+                self._sql.cas_insert, (key, data, expires_at)
+            ).fetchall()
+        self._invalidate((key,))
+        if rows:
+            self._wrote()
+        return bool(rows)
+
+    def transform(
+        self,
+        key: str,
+        fn: Callable[[Any], Any],
+        retries: int = 10,
+        ttl: float | None = None,
+    ) -> Any:
+        # optimistic read-modify-write, only the key itself is contended
+        for attempt in range(retries + 1):
+            value, version = self.get_versioned(key)
+            value = fn(value)
+            if self.cas(key, version, value, ttl):
+                return value
+            time.sleep(random.uniform(0, 0.001 * 2**attempt))
+        raise ConflictError(
+            f"{key!r} kept changing, gave up after {retries} retries"
+        )
+
+    def memoize(
+        self,
+        fn: Callable[..., Any] | None = None,
+        *,
+        ttl: float | None = None,
+        max_entries: int | None = None,
+        max_bytes: int | None = None,
+        policy: str = "lru",
+        lease: float = 60.0,
+        name: str | None = None,
+    ) -> Any:
+        """cache results of a pure function in the db, see utilki.memoize
+
+        >>> @kv.memoize(ttl=3600, max_entries=10_000, policy="lfu")
+        ... def fetch(url: str) -> dict: ...
+        >>> fetch.cache_info()
+        """
+        from .memoize import Memoized
+
+        def decorate(fn: Callable[..., Any]) -> Memoized[..., Any]:
+            return Memoized(
+                self, fn, ttl, max_entries, max_bytes, policy, lease, name
+            )
+
+        return decorate if fn is None else decorate(fn)
+
+    def rate_limit(
+        self,
+        name: str,
+        rate: float | str,
+        burst: float | None = None,
+        algorithm: str = "token_bucket",
+    ) -> Any:
+        """shared rate limit, `rate` per second or like "50/s", "100/m"
+
+        >>> with kv.rate_limit("nomad", "50/s"):
+        ...     submit(job)
+        >>> await kv.rate_limit("nomad", "50/s")
+
+        see utilki.limits, `burst` only applies to the token bucket
+        """
+        from .limits import SlidingWindow, TokenBucket
+
+        args = (name, rate, burst, algorithm)
+        limiter = self._limiters.get(args)
+        if limiter is None:
+            if algorithm == "token_bucket":
+                limiter = TokenBucket(self, name, rate, burst)
+            elif algorithm == "sliding_window":
+                limiter = SlidingWindow(self, name, rate)
+            else:
+                raise ValueError(
+                    f"unknown algorithm {algorithm!r}, expected "
+                    "'token_bucket' or 'sliding_window'"
                 )
-            except sqlite3.IntegrityError:
-                self._execute(
-                    f"UPDATE {self._table} SET value=? WHERE key=?",
-                    (jvalue, key),
+            self._limiters[args] = limiter
+        return limiter
+
+    def lease(
+        self, name: str, ttl: float = 30.0, timeout: float | None = None
+    ) -> Any:
+        """named lock that expires after `ttl` seconds, see utilki.limits"""
+        from .limits import Lease
+
+        return Lease(self, name, ttl, timeout)
+
+    def set(self, key: str, value: Any, ttl: float | None = None):
+        self._execute(
+            self._sql.set, (key, self._encode(value), self._expires_at(ttl))
+        )
+        self._invalidate((key,))
+        self._wrote()
+
+    def __setitem__(self, key: str, value: Any):
+        self.set(key, value)
+
+    def open_blob(
+        self,
+        key: str,
+        mode: str = "rb",
+        size: int | None = None,
+        ttl: float | None = None,
+    ) -> "sqlite3.Blob":
+        """a file-like handle on the stored bytes, to stream them in chunks
+
+        needs python 3.11+ (sqlite3 blobopen). sqlite can't grow a blob,
+        so "wb" stores `size` zero bytes first and the handle writes over
+        them. the bytes skip the codec, so kv[key] reads them back as is
+        only with the bytes codec
+        """
+        if not hasattr(sqlite3.Connection, "blobopen"):
+            raise RuntimeError(
+                "open_blob needs Python 3.11+ (sqlite3 blobopen)"
+            )
+        if self._codec.json:
+            raise TypeError(
+                f"codec {self._codec.name!r} stores text, not blobs"
+            )
+        if mode == "rb":
+            for [rowid] in self._execute(self._sql.rowid, (key,)):
+                return self._db.blobopen(
+                    self._table, "value", rowid, readonly=True
                 )
+            raise KeyError(key)
+        if mode != "wb":
+            raise ValueError(f"mode must be 'rb' or 'wb', not {mode!r}")
+        if size is None:
+            raise ValueError("open_blob(mode='wb') needs the size up front")
+        [[rowid]] = self._execute(
+            self._sql.set_blob, (key, size, self._expires_at(ttl))
+        ).fetchall()
+        self._invalidate((key,))
+        self._wrote()
+        return self._db.blobopen(self._table, "value", rowid, readonly=False)
 
     def __delitem__(self, key: str):
-        if key in self:
-            self._execute(f"DELETE FROM {self._table} WHERE key=?", (key,))
-        else:
+        deleted = self._execute(self._sql.delete, (key,)).fetchall()
+        self._invalidate((key,))
+        # deleting an expired row cleans it up but it wasn't there to delete
+        if not deleted or not deleted[0][0]:
             raise KeyError
 
     @contextmanager
     def lock(self, default: Any = None):
-        if not self._locks:
-            self._execute("BEGIN IMMEDIATE TRANSACTION")
-        self._locks += 1
-        previous_default = deepcopy(self._default)
+        previous_default = self._local.__dict__.get("default", _MISS)
         if default is not None:
-            self._default = deepcopy(default)
+            # misses hand out copies, no need to copy it here
+            self._local.default = default
         try:
-            yield self
+            with self._pool.transaction():
+                yield self
         finally:
-            self._default = deepcopy(previous_default)
-            self._locks -= 1
-            if not self._locks:
-                self._execute("COMMIT")
-
-    def __getattr__(self, name: str) -> "KV":
-        self._attr = name
-        return self
-
-    def __iadd__(self, other: int):
-        if self._attr is None:  # type: ignore
-            raise AttributeError(
-                f"'{type(self).__name__}' object has no attribute '_attr'"
-            )
-        val = self[self._attr]
-        val += other
-        self[self._attr] = val
+            if previous_default is _MISS:
+                self._local.__dict__.pop("default", None)
+            else:
+                self._local.default = previous_default
 
     def dict(self):
-        return dict(self.items())
+        return {
+            key: value
+            for batch in self.iter_batches()
+            for key, value in batch
+        }
 
     def ratio(
         self,
@@ -161,6 +1674,73 @@ class KV(MutableMapping[str, Any]):
         return _ratio
 
 
+class KVStore:
+    """one connection (or one per thread) shared by KVs over many tables
+
+    >>> store = KVStore("app.db")
+    >>> users, jobs = store["users"], store["jobs"]
+    >>> with store.transaction():
+    ...     users["a"] = {"name": "a"}
+    ...     jobs["1"] = {"user": "a"}
+
+    a table is created the first time it's opened, after that the view is
+    cached. extra KV arguments passed to the store apply to every table
+    """
+
+    def __init__(
+        self,
+        db: str = ":memory:",
+        timeout: int = 5,
+        threadsafe: bool = False,
+        profile: str | Mapping[str, Any] | None = None,
+        **kwargs: Any,
+    ):
+        self._db_uri = db
+        self._timeout = timeout
+        self._profile = profile
+        self._kwargs = kwargs
+        self._pool = _open_pool(db, timeout, threadsafe, profile)
+        self._views: dict[str, KV] = {}
+        self._mutex = threading.Lock()
+
+    def kv(self, table: str, **kwargs: Any) -> KV:
+        """the table's KV, `kwargs` only count the first time it's opened"""
+        with self._mutex:
+            view = self._views.get(table)
+            if view is None:
+                view = self._views[table] = KV(
+                    self._db_uri,
+                    table,
+                    timeout=self._timeout,
+                    profile=self._profile,
+                    pool=self._pool,
+                    **{**self._kwargs, **kwargs},
+                )
+            return view
+
+    def __getitem__(self, table: str) -> KV:
+        return self.kv(table)
+
+    def queue(self, table: str, **kwargs: Any) -> "Queue":
+        """a work queue on the store's connection, see utilki.work_queue"""
+        from .work_queue import Queue
+
+        return Queue(table=table, pool=self._pool, **kwargs)
+
+    def __contains__(self, table: str) -> bool:
+        return bool(
+            self._pool.conn.db.execute(
+                _Statements.exists, (table,)
+            ).fetchall()
+        )
+
+    @contextmanager
+    def transaction(self):
+        """one transaction for every table of the store, nests like lock()"""
+        with self._pool.transaction():
+            yield self
+
+
 if __name__ == "__main__":
     kv = KV(default=0)
     kv["a"] = 1
@@ -0,0 +1,541 @@
+"""
+local single-writer KV server
+
+one process owns the db and every other process talks to it over a unix
+socket (or localhost tcp) with RemoteKV, which has the KV api. writes from
+all clients are group-committed by the AsyncKV writer thread, so clients
+never fight over the sqlite write lock.
+
+frames are a 9 byte header (payload size, request id, opcode or status)
+followed by a pickle of the arguments or result. only builtin containers
+and scalars are accepted on either side, unpickling anything that needs an
+import is refused. clients may pipeline requests, replies carry the
+request id and can arrive out of order.
+"""
+
+import asyncio
+import io
+import os
+import pickle
+import random
+import socket
+import struct
+import threading
+import time
+from collections.abc import (
+    Callable,
+    Iterable,
+    Iterator,
+    Mapping,
+    MutableMapping,
+)
+from contextlib import contextmanager
+from itertools import islice
+from typing import Any
+
+from .async_kv import AsyncKV
+from .kv import KV, ConflictError, _KVMethods
+
+HEADER = struct.Struct("!IIB")
+OPS = [
+    "get",
+    "get_many",
+    "len",
+    "contains",
+    "get_versioned",
+    "page",
+    "set",
+    "set_many",
+    "delete",
+    "delete_many",
+    "delete_prefix",
+    "incr",
+    "decr",
+    "incr_many",
+    "cas",
+    "lock",
+    "unlock",
+    "where",
+]
+OPCODES = {name: code for code, name in enumerate(OPS)}
+_READS = {
+    "get",
+    "get_many",
+    "len",
+    "contains",
+    "get_versioned",
+    "page",
+    "where",
+}
+_ERRORS: dict[str, type[Exception]] = {
+    error.__name__: error
+    for error in [
+        KeyError,
+        ValueError,
+        TypeError,
+        IndexError,
+        AttributeError,
+        NotImplementedError,
+        ConflictError,
+    ]
+}
+
+
+class RemoteError(Exception):
+    pass
+
+
+class _Unpickler(pickle.Unpickler):
+    def find_class(self, module: str, name: str):
+        raise pickle.UnpicklingError(f"refusing to load {module}.{name}")
+
+
+def _dumps(obj: Any) -> bytes:
+    return pickle.dumps(obj, protocol=5)
+
+
+def _loads(data: bytes) -> Any:
+    return _Unpickler(io.BytesIO(data)).load()
+
+
+def _page(
+    kv: KV,
+    after: str | None,
+    n: int,
+    prefix: str | None = None,
+    start: str | None = None,
+    end: str | None = None,
+    reverse: bool = False,
+) -> list[tuple[str, Any]]:
+    # the next n items of kv.scan(...) after the key `after`
+    if after is not None and reverse:
+        end = after
+    elif after is not None:
+        start = after
+    items = list(islice(kv.scan(prefix, start, end, reverse=reverse), n + 1))
+    if items and after is not None and items[0][0] == after:
+        return items[1:]
+    return items[:n]
+
+
+def _where(
+    kv: KV, fields: dict[str, Any], after: str | None, n: int
+) -> list[tuple[str, Any]]:
+    return list(islice(kv._where(fields, after), n))
+
+
+class KVServer:
+    def __init__(
+        self,
+        db: str,
+        path: str | None = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        **kwargs: Any,
+    ):
+        self.db = db
+        self.path = path
+        self.host = host
+        self.port = port
+        self.kwargs = kwargs
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._stop: asyncio.Event | None = None
+        self._thread: threading.Thread | None = None
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    def start(self) -> "KVServer":
+        """serve from a daemon thread, returns once it's listening"""
+        ready = threading.Event()
+        self._thread = threading.Thread(
+            target=lambda: asyncio.run(self.serve(ready)),
+            name="KVServer",
+            daemon=True,
+        )
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None and self._stop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+        if self._thread is not None:
+            self._thread.join()
+
+    async def serve(self, ready: threading.Event | None = None):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        async with AsyncKV(self.db, **self.kwargs) as akv:
+            self._akv = akv
+            if self.path is not None:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                server = await asyncio.start_unix_server(
+                    self._handle, path=self.path
+                )
+            else:
+                server = await asyncio.start_server(
+                    self._handle, self.host, self.port
+                )
+                self.port = server.sockets[0].getsockname()[1]
+            if ready is not None:
+                ready.set()
+            async with server:
+                await self._stop.wait()
+            if self.path is not None and os.path.exists(self.path):
+                os.remove(self.path)
+
+    async def _call(
+        self, op: str, args: tuple[Any, ...], ordered: bool = False
+    ) -> Any:
+        akv, kv = self._akv, self._akv.kv
+        if op in ("page", "where"):
+            fn, args = {"page": _page, "where": _where}[op], (kv, *args)
+        else:
+            fn = {
+                "get": kv.__getitem__,
+                "len": kv.__len__,
+                "contains": kv.__contains__,
+                "delete": kv.__delitem__,
+            }.get(op) or getattr(kv, op)
+        if op in _READS and not ordered:
+            return await akv._read(fn, *args)
+        return await akv._write(fn, *args)
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        pending: set[asyncio.Task[None]] = set()
+        writes = 0
+        held: Any = None
+        drain = asyncio.Lock()
+
+        async def run(op: str, args: tuple[Any, ...]) -> Any:
+            nonlocal held, writes
+            if op == "lock":
+                lock = self._akv.lock(*args)
+                await lock.__aenter__()
+                held = lock
+            elif op == "unlock":
+                [failed] = args
+                lock, held = held, None
+                exc = (RemoteError, RemoteError(), None)
+                await lock.__aexit__(*(exc if failed else (None,) * 3))
+            elif op in _READS:
+                # queue behind this client's writes so it reads them back
+                return await self._call(op, args, ordered=writes > 0)
+            else:
+                writes += 1
+                try:
+                    return await self._call(op, args)
+                finally:
+                    writes -= 1
+
+        async def reply(request_id: int, op: str, args: tuple[Any, ...]):
+            try:
+                status, result = 0, await run(op, args)
+            except Exception as e:
+                status = 1
+                result = (
+                    type(e).__name__,
+                    tuple(
+                        arg
+                        if isinstance(arg, (str, int, float))
+                        else str(arg)
+                        for arg in e.args
+                    ),
+                )
+            payload = _dumps(result)
+            writer.write(
+                HEADER.pack(len(payload), request_id, status) + payload
+            )
+            async with drain:
+                await writer.drain()
+
+        try:
+            while True:
+                size, request_id, code = HEADER.unpack(
+                    await reader.readexactly(HEADER.size)
+                )
+                args = _loads(await reader.readexactly(size))
+                op = OPS[code]
+                if op not in ("lock", "unlock"):
+                    task = asyncio.create_task(reply(request_id, op, args))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                    continue
+                # lock boundaries are ordered against everything sent
+                # before them, and run in this task so that requests
+                # created afterwards inherit the lock's context
+                if pending:
+                    await asyncio.gather(*pending)
+                await reply(request_id, op, args)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            if held is not None:
+                await held.__aexit__(RemoteError, RemoteError(), None)
+            writer.close()
+
+
+class RemoteKV(_KVMethods, MutableMapping[str, Any]):
+    def __init__(
+        self,
+        path: str | None = None,
+        host: str = "127.0.0.1",
+        port: int | None = None,
+        timeout: float | None = None,
+    ):
+        if path is not None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.settimeout(timeout)
+            self._sock.connect(path)
+        else:
+            self._sock = socket.create_connection((host, port), timeout)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile("rb")
+        self._next_id = 0
+        self._locks = 0
+        self._local = threading.local()
+        # replies that arrived while waiting for another one
+        self._replies: dict[int, tuple[int, bytes]] = {}
+
+    def _send(
+        self, requests: Iterable[tuple[str, tuple[Any, ...]]]
+    ) -> list[int]:
+        ids, frames = [], []
+        for op, args in requests:
+            self._next_id = (self._next_id + 1) % (1 << 32)
+            payload = _dumps(args)
+            frames.append(
+                HEADER.pack(len(payload), self._next_id, OPCODES[op])
+                + payload
+            )
+            ids.append(self._next_id)
+        self._sock.sendall(b"".join(frames))
+        return ids
+
+    def _recv(self, request_id: int) -> Any:
+        while request_id not in self._replies:
+            header = self._file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise ConnectionError("KV server closed the connection")
+            size, reply_id, status = HEADER.unpack(header)
+            self._replies[reply_id] = (status, self._file.read(size))
+        status, payload = self._replies.pop(request_id)
+        result = _loads(payload)
+        if status:
+            name, args = result
+            raise _ERRORS.get(name, RemoteError)(*args)
+        return result
+
+    def _call(self, op: str, *args: Any) -> Any:
+        [request_id] = self._send([(op, args)])
+        return self._recv(request_id)
+
+    def pipeline(self) -> "Pipeline":
+        return Pipeline(self)
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def __enter__(self) -> "RemoteKV":
+        return self
+
+    def __exit__(self, *exc: Any):
+        self.close()
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        return self._call("incr", key, amount)
+
+    def decr(self, key: str, amount: int = 1) -> int:
+        return self._call("decr", key, amount)
+
+    def incr_many(self, amounts: Mapping[str, int]) -> dict[str, int]:
+        return self._call("incr_many", dict(amounts))
+
+    def set(self, key: str, value: Any, ttl: float | None = None):
+        self._call("set", key, value, ttl)
+
+    def set_many(
+        self,
+        items: Mapping[str, Any] | Iterable[tuple[str, Any]],
+        ttl: float | None = None,
+    ):
+        if isinstance(items, Mapping):
+            items = items.items()
+        self._call("set_many", list(items), ttl)
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        return self._call("get_many", list(keys))
+
+    def delete_many(self, keys: Iterable[str]) -> int:
+        return self._call("delete_many", list(keys))
+
+    def delete_prefix(self, prefix: str) -> int:
+        return self._call("delete_prefix", prefix)
+
+    def get_versioned(self, key: str) -> tuple[Any, int]:
+        return self._call("get_versioned", key)
+
+    def cas(
+        self,
+        key: str,
+        expected_version: int,
+        value: Any,
+        ttl: float | None = None,
+    ) -> bool:
+        return self._call("cas", key, expected_version, value, ttl)
+
+    def transform(
+        self,
+        key: str,
+        fn: Callable[[Any], Any],
+        retries: int = 10,
+        ttl: float | None = None,
+    ) -> Any:
+        # KV.transform on this side of the socket, fn can't be sent over
+        for attempt in range(retries + 1):
+            value, version = self.get_versioned(key)
+            value = fn(value)
+            if self.cas(key, version, value, ttl):
+                return value
+            time.sleep(random.uniform(0, 0.001 * 2**attempt))
+        raise ConflictError(
+            f"{key!r} kept changing, gave up after {retries} retries"
+        )
+
+    def iter_batches(self, n: int = 1000) -> Iterator[list[tuple[str, Any]]]:
+        after = None
+        while batch := self._call("page", after, n):
+            yield batch
+            after = batch[-1][0]
+
+    def scan(
+        self,
+        prefix: str | None = None,
+        start: str | None = None,
+        end: str | None = None,
+        limit: int | None = None,
+        reverse: bool = False,
+        n: int = 1000,
+    ) -> Iterator[tuple[str, Any]]:
+        after = None
+        while limit is None or limit > 0:
+            size = n if limit is None else min(n, limit)
+            batch = self._call(
+                "page", after, size, prefix, start, end, reverse
+            )
+            yield from batch
+            if len(batch) < size:
+                return
+            if limit is not None:
+                limit -= len(batch)
+            after = batch[-1][0]
+
+    def where(self, **fields: Any) -> Iterator[tuple[str, Any]]:
+        after, n = None, 1000
+        while True:
+            batch = self._call("where", fields, after, n)
+            yield from batch
+            if len(batch) < n:
+                return
+            after = batch[-1][0]
+
+    def items(self) -> Iterator[tuple[str, Any]]:  # type: ignore
+        return (item for batch in self.iter_batches() for item in batch)
+
+    def values(self) -> Iterator[Any]:  # type: ignore
+        return (value for _, value in self.items())
+
+    def __len__(self):
+        return self._call("len")
+
+    def __getitem__(self, key: str) -> Any:
+        return self._call("get", key)
+
+    def __contains__(self, key: object) -> bool:
+        return self._call("contains", key)
+
+    def __setitem__(self, key: str, value: Any):
+        self._call("set", key, value, None)
+
+    def __delitem__(self, key: str):
+        self._call("delete", key)
+
+    def __iter__(self):
+        for batch in self.iter_batches():
+            for key, _ in batch:
+                yield key
+
+    def dict(self):
+        return {
+            key: value
+            for batch in self.iter_batches()
+            for key, value in batch
+        }
+
+    @contextmanager
+    def lock(self, default: Any = None):
+        if not self._locks:
+            self._call("lock", default)
+        self._locks += 1
+        failed = False
+        try:
+            yield self
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self._locks -= 1
+            if not self._locks:
+                self._call("unlock", failed)
+
+
+class Pipeline:
+    """queue up requests and send them in one write
+
+    >>> with kv.pipeline() as p:
+    ...     p.incr("a")
+    ...     p.get("b")
+    >>> p.results
+    """
+
+    def __init__(self, kv: RemoteKV):
+        self._kv = kv
+        self._requests: list[tuple[str, tuple[Any, ...]]] = []
+        self.results: list[Any] = []
+
+    def __getattr__(self, op: str):
+        if op not in OPCODES or op in ("lock", "unlock"):
+            raise AttributeError(op)
+
+        def request(*args: Any):
+            if op == "set" and len(args) == 2:
+                args += (None,)
+            self._requests.append((op, args))
+
+        return request
+
+    def execute(self) -> list[Any]:
+        requests, self._requests = self._requests, []
+        ids = self._kv._send(requests) if requests else []
+        results = []
+        for request_id in ids:
+            try:
+                results.append(self._kv._recv(request_id))
+            except (RemoteError, *_ERRORS.values()) as e:
+                results.append(e)
+        self.results = results
+        return results
+
+    def __enter__(self) -> "Pipeline":
+        return self
+
+    def __exit__(self, *exc: Any):
+        if exc[0] is None:
+            self.execute()
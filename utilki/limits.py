@@ -0,0 +1,358 @@
+"""
+rate limits and named leases on top of KV
+
+state lives in tables next to the KV's own, so every process using the db
+shares it. each acquire is a single upsert, so there is nothing to lock
+and no read-modify-write race between processes. awaiting one runs the
+upsert on a worker thread, the event loop only sleeps.
+
+    with kv.rate_limit("nomad", "50/s"):
+        submit(job)
+
+    await kv.rate_limit("nomad", "50/s", algorithm="sliding_window")
+
+    with kv.lease("deploy", ttl=60):
+        deploy()
+"""
+
+import asyncio
+import re
+import time
+import uuid
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any
+from weakref import WeakKeyDictionary
+
+from .kv import _NOW, _Pool
+
+if TYPE_CHECKING:
+    from .kv import KV
+
+UNITS = {"s": 1.0, "m": 60.0, "h": 3600.0, "d": 86400.0}
+_created: "WeakKeyDictionary[_Pool, set[str]]" = WeakKeyDictionary()
+# runs async callers' statements when the KV's connection can't leave its
+# thread, on a KV of its own per (db, table), see _off_loop
+_worker = ThreadPoolExecutor(1, thread_name_prefix="utilki-limits")
+_worker_kvs: dict[tuple[str, str], "KV"] = {}
+
+
+def parse_rate(rate: float | str) -> tuple[float, float]:
+    """50 / "50/s" / "100/m" / "5/10s" -> (count, seconds)"""
+    if not isinstance(rate, str):
+        return float(rate), 1.0
+    match = re.fullmatch(r"\s*([\d.]+)\s*/\s*([\d.]*)\s*([smhd])\s*", rate)
+    if match is None:
+        raise ValueError(
+            f"rate must look like '50/s', '100/m' or '5/10s', not {rate!r}"
+        )
+    count, n, unit = match.groups()
+    return float(count), float(n or 1) * UNITS[unit]
+
+
+class _LimitStatements:
+    def __init__(self, table: str):
+        buckets, windows = f"{table}_buckets", f"{table}_windows"
+        leases = f"{table}_leases"
+        self.create = [
+            (
+                f"CREATE TABLE IF NOT EXISTS {buckets} "
+                "(name PRIMARY KEY, tokens REAL, updated_at REAL)"
+            ),
+            (
+                f"CREATE TABLE IF NOT EXISTS {windows} "
+                "(name PRIMARY KEY, win INTEGER, count REAL, prev REAL)"
+            ),
+            (
+                f"CREATE TABLE IF NOT EXISTS {leases} "
+                "(name PRIMARY KEY, holder, expires_at REAL)"
+            ),
+        ]
+        # tokens refill at :rate per second up to :burst. reserving always
+        # succeeds and may leave the bucket in debt, the caller then waits
+        # until the debt is paid off, which also queues callers fairly
+        refilled = f"min(:burst, tokens + ({_NOW} - updated_at) * :rate)"
+        self.reserve = (
+            f"INSERT INTO {buckets} VALUES (:name, :burst - :n, {_NOW}) "
+            f"ON CONFLICT(name) DO UPDATE SET tokens={refilled} - :n, "
+            f"updated_at={_NOW} RETURNING tokens"
+        )
+        self.take = (
+            f"INSERT INTO {buckets} VALUES (:name, :burst - :n, {_NOW}) "
+            f"ON CONFLICT(name) DO UPDATE SET tokens={refilled} - :n, "
+            f"updated_at={_NOW} WHERE {refilled} >= :n RETURNING tokens"
+        )
+        # sliding window counter: the previous fixed window's count,
+        # weighted by how much of it still overlaps, plus the current one
+        win = f"CAST({_NOW} / :window AS INTEGER)"
+        prev = (
+            f"CASE WHEN {win} = win THEN prev "
+            f"WHEN {win} = win + 1 THEN count ELSE 0 END"
+        )
+        current = f"CASE WHEN {win} = win THEN count ELSE 0 END"
+        estimate = (
+            f"({prev}) * (1 - ({_NOW} / :window - {win})) + ({current})"
+        )
+        self.window = (
+            f"INSERT INTO {windows} SELECT :name, {win}, :n, 0 "
+            "WHERE :n <= :limit "
+            f"ON CONFLICT(name) DO UPDATE SET prev={prev}, "
+            f"count={current} + :n, win={win} "
+            f"WHERE {estimate} + :n <= :limit RETURNING count"
+        )
+        self.lease = (
+            f"INSERT INTO {leases} VALUES (:name, :holder, {_NOW} + :ttl) "
+            "ON CONFLICT(name) DO UPDATE SET holder=excluded.holder, "
+            "expires_at=excluded.expires_at "
+            f"WHERE expires_at <= {_NOW} OR holder=excluded.holder "
+            "RETURNING holder"
+        )
+        self.renew = (
+            f"UPDATE {leases} SET expires_at={_NOW} + :ttl "
+            f"WHERE name=:name AND holder=:holder AND expires_at > {_NOW}"
+        )
+        self.release = (
+            f"DELETE FROM {leases} WHERE name=:name AND holder=:holder"
+        )
+        self.held = (
+            f"SELECT 1 FROM {leases} WHERE name=? AND expires_at > {_NOW}"
+        )
+
+
+async def _off_loop(kv: "KV", fn: Callable[..., Any], *args: Any) -> Any:
+    # fn(kv, *args) on another thread, sqlite may wait out its busy timeout
+    loop = asyncio.get_running_loop()
+    if kv._pool.threadsafe:
+        return await loop.run_in_executor(None, fn, kv, *args)
+    try:
+        open_kv = kv._other_thread()
+    except ValueError:
+        # a private :memory: db only exists on this connection
+        return fn(kv, *args)
+    key = (kv._db_uri, kv._table)
+
+    def run() -> Any:
+        if key not in _worker_kvs:
+            _worker_kvs[key] = open_kv()
+        return fn(_worker_kvs[key], *args)
+
+    return await loop.run_in_executor(_worker, run)
+
+
+def _statements(kv: "KV") -> _LimitStatements:
+    sql = _LimitStatements(kv._table)
+    created = _created.setdefault(kv._pool, set())
+    if kv._table not in created:
+        with kv.lock():
+            for statement in sql.create:
+                kv._execute(statement)
+        created.add(kv._table)
+    return sql
+
+
+class _Limiter:
+    def __init__(self, kv: "KV", name: str):
+        self.kv = kv
+        self.name = name
+        self._sql = _statements(kv)
+
+    def _acquire(
+        self, kv: "KV", n: float, reserve: bool
+    ) -> tuple[bool, float]:
+        # (got it, seconds to wait before using it / before trying again)
+        raise NotImplementedError
+
+    def acquire(
+        self,
+        n: float = 1,
+        blocking: bool = True,
+        timeout: float | None = None,
+    ) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            acquired, wait = self._acquire(
+                self.kv, n, blocking and deadline is None
+            )
+            if acquired:
+                time.sleep(wait)
+                return True
+            if not blocking or (
+                deadline is not None and time.monotonic() + wait > deadline
+            ):
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(
+        self,
+        n: float = 1,
+        blocking: bool = True,
+        timeout: float | None = None,
+    ) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            acquired, wait = await _off_loop(
+                self.kv, self._acquire, n, blocking and deadline is None
+            )
+            if acquired:
+                await asyncio.sleep(wait)
+                return True
+            if not blocking or (
+                deadline is not None and time.monotonic() + wait > deadline
+            ):
+                return False
+            await asyncio.sleep(wait)
+
+    def __enter__(self) -> "_Limiter":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc: Any):
+        pass
+
+    async def __aenter__(self) -> "_Limiter":
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, *exc: Any):
+        pass
+
+    def __await__(self):
+        return self.acquire_async().__await__()
+
+
+class TokenBucket(_Limiter):
+    def __init__(
+        self,
+        kv: "KV",
+        name: str,
+        rate: float | str,
+        burst: float | None = None,
+    ):
+        super().__init__(kv, name)
+        count, seconds = parse_rate(rate)
+        self.rate = count / seconds
+        self.burst = count if burst is None else burst
+
+    def _acquire(
+        self, kv: "KV", n: float, reserve: bool
+    ) -> tuple[bool, float]:
+        if n > self.burst:
+            raise ValueError(f"can't take {n} at once, burst is {self.burst}")
+        params = {
+            "name": self.name,
+            "n": n,
+            "rate": self.rate,
+            "burst": self.burst,
+        }
+        sql = self._sql.reserve if reserve else self._sql.take
+        rows = kv._execute(sql, params).fetchall()
+        if not rows:
+            return False, n / self.rate
+        [[tokens]] = rows
+        return True, max(0.0, -tokens / self.rate)
+
+
+class SlidingWindow(_Limiter):
+    def __init__(self, kv: "KV", name: str, rate: float | str):
+        super().__init__(kv, name)
+        self.limit, self.window = parse_rate(rate)
+
+    def _acquire(
+        self, kv: "KV", n: float, reserve: bool
+    ) -> tuple[bool, float]:
+        params = {
+            "name": self.name,
+            "n": n,
+            "limit": self.limit,
+            "window": self.window,
+        }
+        rows = kv._execute(self._sql.window, params).fetchall()
+        return bool(rows), 0.0 if rows else self.window / self.limit
+
+
+class Lease:
+    """a named lock that expires, so a crashed holder can't keep it
+
+    long jobs should renew() it well within `ttl`
+    """
+
+    def __init__(
+        self,
+        kv: "KV",
+        name: str,
+        ttl: float = 30.0,
+        timeout: float | None = None,
+    ):
+        self.kv = kv
+        self.name = name
+        self.ttl = ttl
+        self.timeout = timeout
+        self.holder = uuid.uuid4().hex
+        self._sql = _statements(kv)
+
+    def _params(self, ttl: float | None = None) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "holder": self.holder,
+            "ttl": self.ttl if ttl is None else ttl,
+        }
+
+    def _try(self, kv: "KV") -> bool:
+        return bool(kv._execute(self._sql.lease, self._params()).fetchall())
+
+    def acquire(
+        self, blocking: bool = True, timeout: float | None = None
+    ) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        wait = 0.005
+        while not self._try(self.kv):
+            if not blocking or (
+                deadline is not None and time.monotonic() >= deadline
+            ):
+                return False
+            time.sleep(wait)
+            wait = min(wait * 2, 0.25)
+        return True
+
+    async def acquire_async(
+        self, blocking: bool = True, timeout: float | None = None
+    ) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        wait = 0.005
+        while not await _off_loop(self.kv, self._try):
+            if not blocking or (
+                deadline is not None and time.monotonic() >= deadline
+            ):
+                return False
+            await asyncio.sleep(wait)
+            wait = min(wait * 2, 0.25)
+        return True
+
+    def renew(self, ttl: float | None = None) -> bool:
+        """False if the lease ran out and may be someone else's by now"""
+        return bool(
+            self.kv._execute(self._sql.renew, self._params(ttl)).rowcount
+        )
+
+    def release(self) -> bool:
+        params = {"name": self.name, "holder": self.holder}
+        return bool(self.kv._execute(self._sql.release, params).rowcount)
+
+    def locked(self) -> bool:
+        return bool(self.kv._execute(self._sql.held, (self.name,)).fetchall())
+
+    def __enter__(self) -> "Lease":
+        if not self.acquire(timeout=self.timeout):
+            raise TimeoutError(f"lease {self.name!r} is held by someone else")
+        return self
+
+    def __exit__(self, *exc: Any):
+        self.release()
+
+    async def __aenter__(self) -> "Lease":
+        if not await self.acquire_async(timeout=self.timeout):
+            raise TimeoutError(f"lease {self.name!r} is held by someone else")
+        return self
+
+    async def __aexit__(self, *exc: Any):
+        self.release()
@@ -0,0 +1,262 @@
+"""
+persistent memoization on top of KV
+
+results live in a `<table>_memo` table next to the KV's own, encoded with
+its codec, so they survive restarts and are shared between processes.
+every row tracks when it was last read and how often, which is what the
+LRU / LFU eviction orders by. a hit is only a read: the reads are tallied
+in memory and written in one batch every `_TOUCH_BATCH` hits or
+`_TOUCH_EVERY` seconds, and before anything is evicted. eviction doesn't
+see other processes' hits since their last batch, and a process that
+dies loses its tally. a caller that misses first takes a lease on the
+row, everyone else asking for the same arguments waits for its result
+instead of computing it again, across threads and processes.
+"""
+
+import functools
+import hashlib
+import inspect
+import json
+import pickle
+import threading
+import time
+from collections.abc import Callable
+from datetime import date, datetime
+from typing import Any, Generic, ParamSpec, TypeVar
+
+from .kv import _NOW, KV, CacheInfo
+
+P = ParamSpec("P")
+R = TypeVar("R")
+POLICIES = {
+    "lru": "accessed_at DESC",
+    "lfu": "hits DESC, accessed_at DESC",
+}
+_TOUCH_BATCH = 1000
+_TOUCH_EVERY = 1.0
+
+
+def _canonical(value: Any) -> Any:
+    # json.dumps would turn tuples into lists before `default` sees them,
+    # so the arguments are walked first and f((1, 2)) != f([1, 2]).
+    # anything json can't take as it is gets tagged, or pickled
+    if value is None or type(value) in (str, int, float, bool):
+        return value
+    if type(value) is list:
+        return [_canonical(item) for item in value]
+    if type(value) is tuple:
+        return {"__tuple__": [_canonical(item) for item in value]}
+    if type(value) is dict and all(type(key) is str for key in value):
+        return {key: _canonical(item) for key, item in value.items()}
+    if isinstance(value, (set, frozenset)):
+        return {"__set__": sorted(map(_canonical, value), key=repr)}
+    if isinstance(value, bytes):
+        return {"__bytes__": value.hex()}
+    if isinstance(value, (datetime, date)):
+        return {"__date__": value.isoformat()}
+    return {"__pickle__": pickle.dumps(value, protocol=4).hex()}
+
+
+class _MemoStatements:
+    def __init__(self, table: str):
+        memo = f"{table}_memo"
+        live = f"(expires_at IS NULL OR expires_at > {_NOW})"
+        self.create = [
+            (
+                f"CREATE TABLE IF NOT EXISTS {memo} (key PRIMARY KEY, fn, "
+                "value, nbytes, expires_at, accessed_at, hits, lease_until)"
+            ),
+            (
+                f"CREATE INDEX IF NOT EXISTS {memo}_lru "
+                f"ON {memo} (fn, accessed_at)"
+            ),
+            (
+                f"CREATE INDEX IF NOT EXISTS {memo}_lfu "
+                f"ON {memo} (fn, hits, accessed_at)"
+            ),
+            (
+                f"CREATE INDEX IF NOT EXISTS {memo}_expires_at "
+                f"ON {memo} (fn, expires_at) WHERE expires_at IS NOT NULL"
+            ),
+        ]
+        self.hit = (
+            f"SELECT value FROM {memo} "
+            f"WHERE key=? AND value IS NOT NULL AND {live}"
+        )
+        self.touch = (
+            f"UPDATE {memo} SET accessed_at=max(accessed_at, ?), "
+            "hits=hits + ? WHERE key=? AND value IS NOT NULL"
+        )
+        # only one caller gets the row back, the others wait for its value
+        self.claim = (
+            f"INSERT INTO {memo} (key, fn, lease_until) "
+            f"VALUES (?, ?, {_NOW} + ?) "
+            "ON CONFLICT(key) DO UPDATE SET lease_until=excluded.lease_until "
+            f"WHERE (value IS NULL OR NOT {live}) "
+            f"AND (lease_until IS NULL OR lease_until <= {_NOW}) "
+            "RETURNING key"
+        )
+        self.store = (
+            f"UPDATE {memo} SET value=?, nbytes=?, expires_at=?, "
+            "accessed_at=?, hits=0, lease_until=NULL WHERE key=?"
+        )
+        # a failed call gives up its lease, keeping an expired value if any
+        self.release_empty = (
+            f"DELETE FROM {memo} WHERE key=? AND value IS NULL"
+        )
+        self.release = f"UPDATE {memo} SET lease_until=NULL WHERE key=?"
+        self.purge = f"DELETE FROM {memo} WHERE fn=? AND expires_at <= {_NOW}"
+        # rows past the first `max_entries` / `max_bytes` in policy order.
+        # the row just stored is left out, under LFU it would always go first
+        self.evict_entries = (
+            f"DELETE FROM {memo} WHERE key IN (SELECT key FROM {memo} "
+            "WHERE fn=? AND key != ? AND value IS NOT NULL "
+            "ORDER BY {} LIMIT -1 OFFSET ?)"
+        )
+        self.evict_bytes = (
+            f"DELETE FROM {memo} WHERE key IN (SELECT key FROM "
+            "(SELECT key, sum(nbytes) OVER (ORDER BY {} ROWS UNBOUNDED "
+            f"PRECEDING) AS total FROM {memo} "
+            "WHERE fn=? AND key != ? AND value IS NOT NULL) WHERE total > ?)"
+        )
+        self.size = (
+            f"SELECT COUNT(*), coalesce(SUM(nbytes), 0) FROM {memo} "
+            "WHERE fn=? AND value IS NOT NULL"
+        )
+        self.clear = f"DELETE FROM {memo} WHERE fn=?"
+
+
+class Memoized(Generic[P, R]):
+    def __init__(
+        self,
+        kv: KV,
+        fn: Callable[P, R],
+        ttl: float | None = None,
+        max_entries: int | None = None,
+        max_bytes: int | None = None,
+        policy: str = "lru",
+        lease: float = 60.0,
+        name: str | None = None,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(
+                f"unknown policy {policy!r}, expected one of {list(POLICIES)}"
+            )
+        self.kv = kv
+        self.fn = fn
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lease = lease
+        self.name = name or f"{fn.__module__}.{fn.__qualname__}"
+        self._order = POLICIES[policy]
+        self._signature = inspect.signature(fn)
+        self._sql = _MemoStatements(kv._table)
+        self._hits = 0
+        self._misses = 0
+        # key -> [last read, reads] not written yet, see _touch
+        self._touched: dict[str, list[Any]] = {}
+        self._touched_at = time.monotonic()
+        self._mutex = threading.Lock()
+        with kv.lock():
+            for sql in self._sql.create:
+                kv._execute(sql)
+        functools.update_wrapper(self, fn)
+
+    def key(self, *args: P.args, **kwargs: P.kwargs) -> str:
+        # same key however the arguments are passed, f(1, b=2) == f(1, 2)
+        bound = self._signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        data = json.dumps(
+            _canonical(dict(bound.arguments)),
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        digest = hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+        return f"{self.name}:{digest}"
+
+    def __call__(self, *args: P.args, **kwargs: P.kwargs) -> R:
+        kv, sql = self.kv, self._sql
+        key = self.key(*args, **kwargs)
+        wait = 0.001
+        while True:
+            for [value] in kv._execute(sql.hit, (key,)).fetchall():
+                self._touch(key)
+                return kv._decode(value)
+            if kv._execute(
+                sql.claim, (key, self.name, self.lease)
+            ).fetchall():
+                break
+            # someone else is computing it
+            time.sleep(wait)
+            wait = min(wait * 2, 0.1)
+        with self._mutex:
+            self._misses += 1
+        try:
+            result = self.fn(*args, **kwargs)
+            data = kv._encode(result)
+        except BaseException:
+            with kv.lock():
+                kv._execute(sql.release_empty, (key,))
+                kv._execute(sql.release, (key,))
+            raise
+        with kv.lock():
+            kv._execute(
+                sql.store,
+                (data, len(data), kv._expires_at(self.ttl), time.time(), key),
+            )
+            self._evict(key, len(data))
+        return result
+
+    def _touch(self, key: str):
+        # python's clock, sqlite's 'now' only has millisecond precision
+        now = time.time()
+        with self._mutex:
+            self._hits += 1
+            touched = self._touched.setdefault(key, [now, 0])
+            touched[0] = now
+            touched[1] += 1
+            due = len(self._touched) >= _TOUCH_BATCH or (
+                time.monotonic() - self._touched_at >= _TOUCH_EVERY
+            )
+        if due:
+            with self.kv.lock():
+                self._flush_touched()
+
+    def _flush_touched(self):
+        with self._mutex:
+            touched, self._touched = self._touched, {}
+            self._touched_at = time.monotonic()
+        self.kv._db.cursor().executemany(
+            self._sql.touch,
+            ((at, n, key) for key, [at, n] in touched.items()),
+        )
+
+    def _evict(self, key: str, nbytes: int):
+        kv, sql = self.kv, self._sql
+        # eviction orders by the reads, write the ones still in memory
+        self._flush_touched()
+        if self.ttl is not None or kv._default_ttl is not None:
+            kv._execute(sql.purge, (self.name,))
+        if self.max_entries is not None:
+            kv._execute(
+                sql.evict_entries.format(self._order),
+                (self.name, key, self.max_entries - 1),
+            )
+        if self.max_bytes is not None:
+            kv._execute(
+                sql.evict_bytes.format(self._order),
+                (self.name, key, self.max_bytes - nbytes),
+            )
+
+    def cache_info(self) -> CacheInfo:
+        [[currsize, nbytes]] = self.kv._execute(self._sql.size, (self.name,))
+        return CacheInfo(
+            self._hits, self._misses, self.max_entries or 0, currsize, nbytes
+        )
+
+    def cache_clear(self):
+        self.kv._execute(self._sql.clear, (self.name,))
+        with self._mutex:
+            self._hits = self._misses = 0
+            self._touched = {}
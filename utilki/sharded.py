@@ -0,0 +1,158 @@
+"""
+KV spread over several sqlite files
+
+sqlite allows one writer per file, so writers to different shards don't
+wait for each other. keys are assigned to shards by crc32, which is
+stable across processes, and the shard count is recorded in every shard so
+reopening with a different count fails instead of losing keys.
+"""
+
+import heapq
+import threading
+import zlib
+from collections.abc import Iterable, Iterator, Mapping, MutableMapping
+from contextlib import ExitStack, contextmanager
+from operator import itemgetter
+from typing import Any
+
+from .kv import KV, _KVMethods
+
+
+class ShardedKV(_KVMethods, MutableMapping[str, Any]):
+    def __init__(self, db: str = ":memory:", shards: int = 8, **kwargs: Any):
+        if shards < 1:
+            raise ValueError("need at least one shard")
+        self.shards = [
+            KV(db if db == ":memory:" else f"{db}.{i}", **kwargs)
+            for i in range(shards)
+        ]
+        for shard in self.shards:
+            stored = shard._get_meta("shards")
+            if stored is None:
+                shard._set_meta("shards", shards)
+            elif stored != shards:
+                raise ValueError(
+                    f"{db!r} was created with {stored} shards, not {shards}"
+                )
+        self._local = threading.local()
+
+    def shard(self, key: str) -> KV:
+        return self.shards[zlib.crc32(key.encode()) % len(self.shards)]
+
+    def _group(self, keys: Iterable[str]) -> dict[int, list[str]]:
+        groups: dict[int, list[str]] = {}
+        n = len(self.shards)
+        for key in keys:
+            groups.setdefault(zlib.crc32(key.encode()) % n, []).append(key)
+        return groups
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        return self.shard(key).incr(key, amount)
+
+    def decr(self, key: str, amount: int = 1) -> int:
+        return self.shard(key).decr(key, amount)
+
+    def incr_many(self, amounts: Mapping[str, int]) -> dict[str, int]:
+        result = {}
+        for i, keys in self._group(amounts).items():
+            result.update(
+                self.shards[i].incr_many({key: amounts[key] for key in keys})
+            )
+        return result
+
+    def get_versioned(self, key: str) -> tuple[Any, int]:
+        return self.shard(key).get_versioned(key)
+
+    def cas(
+        self,
+        key: str,
+        expected_version: int,
+        value: Any,
+        ttl: float | None = None,
+    ) -> bool:
+        return self.shard(key).cas(key, expected_version, value, ttl)
+
+    def transform(self, key: str, fn: Any, **kwargs: Any) -> Any:
+        return self.shard(key).transform(key, fn, **kwargs)
+
+    def set(self, key: str, value: Any, ttl: float | None = None):
+        self.shard(key).set(key, value, ttl)
+
+    def set_many(
+        self,
+        items: Mapping[str, Any] | Iterable[tuple[str, Any]],
+        ttl: float | None = None,
+    ):
+        items = dict(items)
+        for i, keys in self._group(items).items():
+            self.shards[i].set_many(((key, items[key]) for key in keys), ttl)
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        keys = list(keys)
+        found = {}
+        for i, group in self._group(keys).items():
+            found.update(self.shards[i].get_many(group))
+        return {key: found[key] for key in keys if key in found}
+
+    def delete_many(self, keys: Iterable[str]) -> int:
+        return sum(
+            self.shards[i].delete_many(group)
+            for i, group in self._group(keys).items()
+        )
+
+    def scan(
+        self,
+        prefix: str | None = None,
+        start: str | None = None,
+        end: str | None = None,
+        limit: int | None = None,
+        reverse: bool = False,
+    ) -> Iterator[tuple[str, Any]]:
+        # every shard streams its range in key order, merging keeps it so
+        merged = heapq.merge(
+            *(
+                shard.scan(prefix, start, end, limit, reverse)
+                for shard in self.shards
+            ),
+            key=itemgetter(0),
+            reverse=reverse,
+        )
+        for n, item in enumerate(merged):
+            if limit is not None and n >= limit:
+                return
+            yield item
+
+    def delete_prefix(self, prefix: str) -> int:
+        return sum(shard.delete_prefix(prefix) for shard in self.shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __getitem__(self, key: str) -> Any:
+        return self.shard(key)[key]
+
+    def __setitem__(self, key: str, value: Any):
+        self.shard(key)[key] = value
+
+    def __delitem__(self, key: str):
+        del self.shard(key)[key]
+
+    def __iter__(self):
+        return (key for key, _ in self.scan())
+
+    def items(self) -> Iterator[tuple[str, Any]]:  # type: ignore
+        return self.scan()
+
+    def values(self) -> Iterator[Any]:  # type: ignore
+        return (value for _, value in self.scan())
+
+    def dict(self):
+        return dict(self.scan())
+
+    @contextmanager
+    def lock(self, default: Any = None):
+        # every shard, always in the same order so two lockers can't deadlock
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.lock(default))
+            yield self
@@ -0,0 +1,164 @@
+"""
+durable work queue on the same sqlite machinery as KV
+
+jobs are rows in their own table. claim() leases a batch in one UPDATE,
+highest priority first and then the ones that have been ready longest, by
+pushing their `visible_at` into the future. a job that isn't acked before
+its lease runs out becomes visible again and is handed to the next claim,
+so crashed workers lose nothing. every claim bumps `attempts`, which
+ack() / nack() check so a worker whose lease ran out can't ack a job
+someone else holds.
+"""
+
+from collections.abc import Iterable, Mapping
+from typing import Any, NamedTuple
+
+from .codec import Codec, get_codec
+from .kv import _NOW, CHUNK_SIZE, _chunks, _open_pool, _Pool
+
+
+class Job(NamedTuple):
+    id: int
+    value: Any
+    priority: int
+    attempts: int
+
+
+class _QueueStatements:
+    def __init__(self, table: str):
+        self.create = [
+            (
+                f"CREATE TABLE IF NOT EXISTS {table} "
+                "(id INTEGER PRIMARY KEY, value, "
+                "priority INTEGER NOT NULL DEFAULT 0, "
+                "visible_at REAL NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0)"
+            ),
+            (
+                f"CREATE INDEX IF NOT EXISTS {table}_ready "
+                f"ON {table} (priority DESC, visible_at, id)"
+            ),
+        ]
+        self.put = (
+            f"INSERT INTO {table} (value, priority, visible_at) "
+            f"VALUES (?, ?, {_NOW} + ?)"
+        )
+        # walk the priorities from the top, one index seek each, and take
+        # the ready rows of each from the front of its visible_at range, so
+        # leased and delayed jobs are never looked at. CROSS JOIN keeps that
+        # order, which is what LIMIT picks from
+        self.claim = (
+            "WITH RECURSIVE priorities(p) AS ("
+            f"SELECT max(priority) FROM {table} UNION ALL "
+            f"SELECT (SELECT max(priority) FROM {table} WHERE priority < p) "
+            "FROM priorities WHERE p IS NOT NULL) "
+            f"UPDATE {table} SET visible_at={_NOW} + ?, "
+            "attempts=attempts + 1 "
+            f"WHERE id IN (SELECT id FROM priorities CROSS JOIN {table} "
+            f"ON priority=p WHERE visible_at <= {_NOW} LIMIT ?) "
+            "RETURNING id, value, priority, attempts"
+        )
+        self.ack = f"DELETE FROM {table} WHERE id=? AND attempts=?"
+        self.nack = (
+            f"UPDATE {table} SET visible_at={_NOW} + ? "
+            "WHERE id=? AND attempts=?"
+        )
+        self.count = f"SELECT COUNT(*) FROM {table}"
+        self.count_ready = (
+            f"SELECT COUNT(*) FROM {table} WHERE visible_at <= {_NOW}"
+        )
+        self.clear = f"DELETE FROM {table}"
+
+
+class Queue:
+    def __init__(
+        self,
+        db: str = ":memory:",
+        table: str = "queue",
+        lease: float = 30.0,
+        timeout: int = 5,
+        codec: str | Codec = "json",
+        threadsafe: bool = False,
+        profile: str | Mapping[str, Any] | None = None,
+        pool: _Pool | None = None,
+    ):
+        self.lease = lease
+        self._codec = get_codec(codec)
+        self._pool = pool or _open_pool(db, timeout, threadsafe, profile)
+        self._sql = _QueueStatements(table)
+        with self._pool.transaction():
+            for sql in self._sql.create:
+                self._execute(sql)
+
+    def _execute(self, sql: str, params: tuple[Any, ...] = ()):
+        return self._pool.conn.db.cursor().execute(sql, params)
+
+    def put(self, value: Any, priority: int = 0, delay: float = 0) -> int:
+        return self._execute(
+            self._sql.put, (self._codec.encode(value), priority, delay)
+        ).lastrowid  # type: ignore
+
+    def put_many(
+        self, values: Iterable[Any], priority: int = 0, delay: float = 0
+    ) -> int:
+        encode = self._codec.encode
+        n = 0
+        with self._pool.transaction() as conn:
+            for chunk in _chunks(values, CHUNK_SIZE):
+                conn.db.cursor().executemany(
+                    self._sql.put,
+                    ((encode(value), priority, delay) for value in chunk),
+                )
+                n += len(chunk)
+        return n
+
+    def claim(self, batch: int = 1, lease: float | None = None) -> list[Job]:
+        """lease up to `batch` ready jobs for `lease` seconds"""
+        lease = self.lease if lease is None else lease
+        rows = self._execute(self._sql.claim, (lease, batch)).fetchall()
+        jobs = [
+            Job(id, self._codec.decode(value), priority, attempts)
+            for id, value, priority, attempts in rows
+        ]
+        # RETURNING comes back in no particular order
+        jobs.sort(key=lambda job: (-job.priority, job.id))
+        return jobs
+
+    def ack(self, jobs: Job | Iterable[Job]) -> int:
+        """done, delete them. jobs whose lease ran out and were claimed
+        again don't count"""
+        if isinstance(jobs, Job):
+            jobs = [jobs]
+        with self._pool.transaction() as conn:
+            cursor = conn.db.cursor()
+            cursor.executemany(
+                self._sql.ack, ((job.id, job.attempts) for job in jobs)
+            )
+            return cursor.rowcount
+
+    def nack(self, jobs: Job | Iterable[Job], delay: float = 0) -> int:
+        """give them back, visible again after `delay` seconds"""
+        if isinstance(jobs, Job):
+            jobs = [jobs]
+        with self._pool.transaction() as conn:
+            cursor = conn.db.cursor()
+            cursor.executemany(
+                self._sql.nack,
+                ((delay, job.id, job.attempts) for job in jobs),
+            )
+            return cursor.rowcount
+
+    def extend(self, jobs: Job | Iterable[Job], lease: float | None = None):
+        """push the lease of jobs still being worked on"""
+        return self.nack(jobs, self.lease if lease is None else lease)
+
+    def ready(self) -> int:
+        [[n]] = self._execute(self._sql.count_ready)
+        return n
+
+    def clear(self):
+        self._execute(self._sql.clear)
+
+    def __len__(self):
+        [[n]] = self._execute(self._sql.count)
+        return n